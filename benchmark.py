@@ -0,0 +1,148 @@
+#Throughput benchmark for ts_processor.py: GPS points per second of every parser and frames per second end to end
+#Usage: python benchmark.py --fixtures fixtures --repeat 3 [ts_processor.py options for the extraction runs]
+#Missing synthetic fixtures are built with make_fixtures.py, real videos put in the same folder are measured too.
+#--nmea_sentences compares the NMEA sentence parser with the string splitting it replaced, in sentences per second.
+#Every run is appended to --results together with the git commit, so results of different commits can be compared
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+import make_fixtures
+import ts_processor
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--fixtures', default = 'fixtures', type=str) #folder with the videos to measure
+parser.add_argument('--duration', default = '120', type=int) #length in seconds of fixtures that have to be built
+parser.add_argument('--repeat', default = '3', type=int) #runs per measurement, the fastest one counts
+parser.add_argument('--extract', default = '1', type=int) #also measure frame extraction, 0 for parsers only
+parser.add_argument('--nmea_sentences', default = '100000', type=int) #sentences for the NMEA parser benchmark, 0 to skip it
+parser.add_argument('--results', default = 'benchmark_results.jsonl', type=str) #file the results are appended to, empty to not save them
+
+def build_fixtures(args):
+    fixture_args = make_fixtures.parser.parse_args(["--folder", args.fixtures, "--duration", str(args.duration)])
+    os.makedirs(args.fixtures, exist_ok = True)
+    points = None
+    for device, extension in make_fixtures.EXTENSIONS.items():
+        if not os.path.exists(os.path.join(args.fixtures, "fixture_" + device + extension)):
+            points = points or make_fixtures.make_track(fixture_args)
+            print ("Building", make_fixtures.make_fixture(device, fixture_args, points))
+
+def best_time(function, repeat):
+    #Returns the shortest run time and the result of the function
+    best = None
+    for x in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+def quiet(function, *function_args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*function_args)
+
+def nmea_box(count):
+    #Payload of an MP4 gps box, [unix time]$GPRMC and $GPGGA lines
+    fixture_args = make_fixtures.parser.parse_args(["--duration", str(max(1, count // 2))])
+    lines = []
+    for point in make_fixtures.make_track(fixture_args):
+        for sentence in make_fixtures.nmea_sentences(point):
+            lines.append(("[%d]%s" % (point["ts"], sentence)).encode("ascii"))
+    return b"\n".join(lines[:count]) + b"\n"
+
+def legacy_nmea(data):
+    #The per sentence handling of ts_processor.py before the streaming parser: str() of the bytes and a split per field
+    points = []
+    prevts = -1
+    for line in data.splitlines():
+        m = str(line)
+        if "$GPRMC" in m:
+            currentdata = {}
+            currentdata["ts"] = int(m[3:13])
+            try:
+                currentdata["lat"] = float(m.split(",")[3][0:2]) + float(m.split(",")[3][2:]) / 60
+                currentdata["latR"] = m.split(",")[4]
+                if currentdata["latR"] == "S":
+                    currentdata["lat"] = - currentdata["lat"]
+                currentdata["lon"] = float(m.split(",")[5][0:3]) + float(m.split(",")[5][3:]) / 60
+                currentdata["lonR"] = m.split(",")[6]
+                if currentdata["lonR"] == "N":
+                    currentdata["lon"] = - currentdata["lon"]
+            except:
+                pass
+            try:
+                currentdata["bearing"] = float(m.split(",")[9])
+                currentdata["speed"] = float(m.split(",")[8])*1.6/3.6
+            except:
+                currentdata["bearing"] = 0
+                currentdata["speed"] = 0
+            active = (m.split(",")[2])
+            try:
+                currentdata["mx"],currentdata["my"] = ts_processor.lonlat_metric(currentdata["lon"],currentdata["lat"])
+            except:
+                pass
+            if active == "A" and currentdata["ts"] > prevts:
+                points.append(currentdata)
+                prevts = currentdata["ts"]
+    return points
+
+def streaming_nmea(data):
+    return ts_processor.Track.from_rows(ts_processor.nmea_points(ts_processor.read_nmea((data,)), lambda prefix, fields: int(prefix)))
+
+def benchmark_nmea(args):
+    data = nmea_box(args.nmea_sentences)
+    sentences = data.count(b"$")
+    print ("parser;sentences;points;seconds;sentences/s")
+    results = {}
+    for name, function in (("legacy", legacy_nmea), ("streaming", streaming_nmea)):
+        seconds, points = best_time(lambda: function(data), args.repeat)
+        results[name] = {"sentences": sentences, "points": len(points), "seconds": seconds, "sentences_per_second": sentences / seconds}
+        print (name, sentences, len(points), "%.4f" % seconds, "%.0f" % (sentences / seconds), sep=";")
+    return results
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def main():
+    args, processor_options = parser.parse_known_args()
+    build_fixtures(args)
+    files = sorted(glob.glob(os.path.join(args.fixtures, "*.ts")) + glob.glob(os.path.join(args.fixtures, "*.mp4")))
+    results = []
+    nmea = benchmark_nmea(args) if args.nmea_sentences > 0 else {}
+    with tempfile.TemporaryDirectory() as output:
+        ts_processor.setup(ts_processor.parser.parse_args(["--input", args.fixtures, "--folder", output, "--cache", "0", "--manifest", "0"] + processor_options))
+        print ("file;type;MB;points;parse s;points/s;images;extract s;frames/s")
+        for file_name in files:
+            device, make, model = quiet(ts_processor.sniff_file_type, file_name)
+            if device not in ts_processor.GPS_PARSERS:
+                print (file_name, device, "no GPS parser, skipped", sep=";")
+                continue
+            seconds, track = best_time(lambda: quiet(ts_processor.GPS_PARSERS[device], file_name, device), args.repeat)
+            result = {"file": os.path.basename(file_name), "type": device, "bytes": os.path.getsize(file_name), "points": len(track),
+                      "parse_seconds": seconds, "points_per_second": len(track) / seconds}
+            if args.extract == 1:
+                seconds, summary = best_time(lambda: quiet(ts_processor.process_file, file_name), args.repeat)
+                result.update({"images": summary["images"], "extract_seconds": seconds, "frames_per_second": summary["images"] / seconds})
+            results.append(result)
+            print (result["file"], device, "%.1f" % (result["bytes"] / 1e6), result["points"], "%.4f" % result["parse_seconds"], "%.0f" % result["points_per_second"],
+                   result.get("images", ""), "%.3f" % result["extract_seconds"] if "extract_seconds" in result else "",
+                   "%.1f" % result["frames_per_second"] if "frames_per_second" in result else "", sep=";")
+
+    if args.results:
+        with open(args.results, "a") as f:
+            f.write(json.dumps({"commit": get_commit(), "date": datetime.now().isoformat(timespec = "seconds"), "options": processor_options, "results": results, "nmea": nmea}) + "\n")
+        print ("Results appended to", args.results)
+
+if __name__ == "__main__":
+    main()
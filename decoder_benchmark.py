@@ -0,0 +1,35 @@
+#Compares the decoder backends and decode modes of ts_processor.py on one video
+#Usage: python decoder_benchmark.py --input 20210311080720_000421.TS --sampling_interval 0.5
+#Takes the same options as ts_processor.py, --decoder_threads and --skip_nonref apply to the pyav runs
+
+import time
+import cv2
+import ts_processor
+
+def main():
+    ts_processor.setup(ts_processor.parser.parse_args())
+    input_file = ts_processor.args.input
+    video = cv2.VideoCapture(input_file)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    length = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    step = max(1, int(fps*ts_processor.args.sampling_interval))
+    schedule = list(range(0, length, step))
+    keyframes = ts_processor.get_keyframes(input_file)
+    print ("FPS : {0}; LEN: {1}; samples: {2}; keyframes: {3}".format(fps, length, len(schedule), len(keyframes)))
+
+    print ("decoder;mode;frames;seconds;frames/s")
+    for name, decoder_class in ts_processor.DECODERS.items():
+        for decode_mode in ("seek", "stream", "gop"):
+            try:
+                with decoder_class(input_file) as decoder:
+                    start = time.perf_counter()
+                    frames = sum(1 for frame in decoder.read_frames(schedule, decode_mode, keyframes))
+                    seconds = time.perf_counter() - start
+            except ImportError as e:
+                print (name, "not available: " + str(e), sep=";")
+                break
+            print (name, decode_mode, frames, "%.3f" % seconds, "%.1f" % (frames/max(seconds, 1e-9)), sep=";")
+
+if __name__ == "__main__":
+    main()
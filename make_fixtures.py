@@ -0,0 +1,196 @@
+#Builds synthetic dashcam videos with embedded GPS for testing and benchmarking ts_processor.py
+#Usage: python make_fixtures.py --folder fixtures --duration 60 --types V,B,T,G,NB,N
+#The video is written by OpenCV, the GPS payload is one point per second of video in the layout of each camera type:
+#V   Viofo A119 V3 TS, GPS in 188 byte packets starting with 47 43 00
+#B   Blueskysea B4K TS, GPS in packets starting with 47 03 00, the time in the tail of the packet before
+#T   Novatek MP4, freeGPS blocks in an mdat box listed by a top level gps box
+#G   Garmin MP4, PNDM records
+#NB  NextBase MP4, timestamped $GPRMC/$GPGGA sentences
+#N   MP4 with a gps box of NMEA sentences inside a top level free box
+
+import argparse
+import math
+import os
+import struct
+from datetime import datetime, timezone
+import cv2
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--folder', default = 'fixtures', type=str) #output folder, will be created if not exists
+parser.add_argument('--duration', default = '60', type=int) #video length in seconds, one GPS point per second
+parser.add_argument('--fps', default = '30', type=float) #video frame rate
+parser.add_argument('--width', default = '320', type=int) #video frame width
+parser.add_argument('--height', default = '240', type=int) #video frame height
+parser.add_argument('--types', default = 'V,B,T,G,NB,N', type=str) #comma separated camera types to build
+parser.add_argument('--speed', default = '15', type=float) #driving speed in m/s
+parser.add_argument('--start', default = '2021-03-11 12:30:00', type=str) #UTC time of the first point
+parser.add_argument('--inactive', default = '', type=str) #comma separated point numbers written without a fix
+
+EXTENSIONS = {"V": ".ts", "B": ".ts", "T": ".mp4", "G": ".mp4", "NB": ".mp4", "N": ".mp4"}
+EARTH_RADIUS = 6378137.0
+
+def make_track(args):
+    '''One point per second along a gentle curve. Returns a list of dicts with ts, lat, lon, speed (m/s), bearing and active'''
+    start = datetime.strptime(args.start, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    inactive = set(int(x) for x in args.inactive.split(",") if x)
+    lat, lon, bearing = 58.38, 26.72, 45.0
+    points = []
+    for i in range(args.duration):
+        points.append({"ts": start + i, "lat": lat, "lon": lon, "speed": args.speed, "bearing": bearing, "active": i not in inactive})
+        lat += args.speed * math.cos(math.radians(bearing)) / EARTH_RADIUS * 180 / math.pi
+        lon += args.speed * math.sin(math.radians(bearing)) / (EARTH_RADIUS * math.cos(math.radians(lat))) * 180 / math.pi
+        bearing = (bearing + 0.5) % 360
+    return points
+
+def write_video(file_name, args):
+    #Moving gradient with the frame number drawn in, so extracted frames can be told apart
+    video = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*"mp4v"), args.fps, (args.width, args.height))
+    if not video.isOpened():
+        raise RuntimeError("OpenCV cannot write " + file_name)
+    gradient = np.tile(np.linspace(0, 255, args.width, dtype=np.float32), (args.height, 1))
+    for framecount in range(int(args.duration * args.fps)):
+        channel = ((gradient + framecount * 4) % 256).astype(np.uint8)
+        image = cv2.merge([channel, np.flipud(channel), np.full_like(channel, framecount % 256)])
+        cv2.putText(image, str(framecount), (10, args.height // 2), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+        video.write(image)
+    video.release()
+
+def to_nmea(value):
+    #degrees to the ddmm.mmmm number the cameras store
+    degrees = int(abs(value))
+    return degrees * 100 + (abs(value) - degrees) * 60
+
+def hemispheres(point):
+    return (b"N" if point["lat"] >= 0 else b"S") + (b"E" if point["lon"] >= 0 else b"W")
+
+def utc(point):
+    return datetime.fromtimestamp(point["ts"], timezone.utc)
+
+def knots(point):
+    return point["speed"] * 3.6 / 1.6 #ts_processor reads speeds as speed * 1.6 / 3.6
+
+def novatek_payload(point, size, offset = 0):
+    #Viofo TS packets and Novatek blocks share the layout, Novatek fields start 2 bytes later
+    t = utc(point)
+    payload = bytearray(size)
+    struct.pack_into("<6I", payload, offset + 10, t.hour, t.minute, t.second, t.year - 2000, t.month, t.day)
+    payload[offset + 34:offset + 35] = b"A" if point["active"] else b"V"
+    payload[offset + 35:offset + 37] = hemispheres(point)
+    struct.pack_into("<4f", payload, offset + 38, to_nmea(point["lat"]), to_nmea(point["lon"]), knots(point), point["bearing"])
+    return payload
+
+def viofo_packet(point):
+    packet = novatek_payload(point, 188)
+    packet[0:3] = b"\x47\x43\x00"
+    return bytes(packet)
+
+def b4k_packets(point):
+    #null packet carrying the time, then the GPS packet
+    t = utc(point)
+    previous = bytearray(188)
+    previous[0:4] = b"\x47\x1F\xFF\x10"
+    struct.pack_into("<3IH", previous, 174, t.hour, t.minute, t.second, (t.year - 2000) & 0xFFFF)
+    packet = bytearray(188)
+    packet[0:3] = b"\x47\x03\x00"
+    struct.pack_into("<H2I", packet, 146, (t.year - 2000) >> 16, t.month, t.day)
+    packet[156:157] = b"A" if point["active"] else b"V"
+    packet[157:159] = hemispheres(point)
+    struct.pack_into("<4f", packet, 160, to_nmea(point["lat"]), to_nmea(point["lon"]), knots(point), point["bearing"])
+    return bytes(previous) + bytes(packet)
+
+def add_ts_gps(file_name, points, device):
+    #Spreads the GPS packets evenly between the video packets, never before the first one
+    with open(file_name, "rb") as f:
+        data = f.read()
+    packets = [data[i:i + 188] for i in range(0, len(data) - len(data) % 188, 188)]
+    step = max(1, len(packets) // len(points))
+    out = []
+    for i, packet in enumerate(packets):
+        out.append(packet)
+        if i % step == step - 1 and i // step < len(points):
+            point = points[i // step]
+            out.append(viofo_packet(point) if device == "V" else b4k_packets(point))
+    with open(file_name, "wb") as f:
+        f.write(b"".join(out))
+
+def box(box_type, data):
+    return struct.pack(">I", len(data) + 8) + box_type + data
+
+def nmea_sentence(body):
+    checksum = 0
+    for c in body.encode("ascii"):
+        checksum ^= c
+    return "$%s*%02X" % (body, checksum)
+
+def nmea_sentences(point):
+    t = utc(point)
+    lat = "%09.4f,%s" % (to_nmea(point["lat"]), "N" if point["lat"] >= 0 else "S")
+    lon = "%010.4f,%s" % (to_nmea(point["lon"]), "E" if point["lon"] >= 0 else "W")
+    rmc = nmea_sentence("GPRMC,%s.00,%s,%s,%s,%.1f,%.1f,%s,,,A" % (t.strftime("%H%M%S"), "A" if point["active"] else "V", lat, lon, knots(point), point["bearing"], t.strftime("%d%m%y")))
+    gga = nmea_sentence("GPGGA,%s.00,%s,%s,%d,08,0.9,45.0,M,19.0,M,," % (t.strftime("%H%M%S"), lat, lon, 1 if point["active"] else 0))
+    return rmc, gga
+
+def novatek_boxes(points):
+    #freeGPS blocks inside an mdat box, and the gps box table of their (offset, size) the cameras write
+    block_size = 256
+    blocks = []
+    for point in points:
+        payload = novatek_payload(point, block_size - 4, 2)
+        payload[0:8] = b"freeGPS "
+        blocks.append(struct.pack(">I", block_size) + bytes(payload))
+    return blocks, block_size
+
+def add_mp4_gps(file_name, points, device):
+    with open(file_name, "ab") as f:
+        if device == "T":
+            blocks, block_size = novatek_boxes(points)
+            table_size = 8 + 8 + 8 * len(blocks)
+            first_block = f.tell() + table_size + 8 #after the gps box and the mdat header
+            table = struct.pack(">II", 0x101, len(blocks)) + b"".join(struct.pack(">II", first_block + i * block_size, block_size) for i in range(len(blocks)))
+            f.write(box(b"gps ", table))
+            f.write(box(b"mdat", b"".join(blocks)))
+        if device == "G":
+            records = []
+            for point in points:
+                record = bytearray(56)
+                record[0:10] = b"\x00\x14\x50\x4E\x44\x4D\x00\x00\x00\x00"
+                record[10] = min(255, int(round(knots(point))))
+                struct.pack_into(">ii", record, 14, int(point["lat"] * 11930464.711111112), int(point["lon"] * 11930464.711111112))
+                records.append(bytes(record))
+            f.write(box(b"mdat", b"".join(records)))
+        if device == "NB":
+            records = []
+            for point in points:
+                rmc, gga = nmea_sentences(point)
+                records.append(utc(point).strftime("%Y%m%d%H%M%S").encode("ascii") + b"\x00" * 14 + (rmc + "\r\n" + gga + "\r\n").encode("ascii") + b"\x00" * 32)
+            f.write(box(b"mdat", b"".join(records)))
+        if device == "N":
+            lines = []
+            for point in points:
+                for sentence in nmea_sentences(point):
+                    lines.append("[%d]%s" % (point["ts"], sentence))
+            f.write(box(b"free", box(b"gps ", ("\n".join(lines) + "\n").encode("ascii"))))
+
+def make_fixture(device, args, points):
+    file_name = os.path.join(args.folder, "fixture_" + device + EXTENSIONS[device])
+    write_video(file_name, args)
+    if device in ("V", "B"):
+        add_ts_gps(file_name, points, device)
+    else:
+        add_mp4_gps(file_name, points, device)
+    return file_name
+
+def main():
+    args = parser.parse_args()
+    os.makedirs(args.folder, exist_ok = True)
+    points = make_track(args)
+    for device in args.types.split(","):
+        if device not in EXTENSIONS:
+            print ("Unknown type", device, "skipped")
+            continue
+        file_name = make_fixture(device, args, points)
+        print (file_name, os.path.getsize(file_name), "bytes,", len(points), "points")
+
+if __name__ == "__main__":
+    main()
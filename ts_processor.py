@@ -4,8 +4,8 @@
 import struct
 import sys
 import cv2
+import numpy as np
 import piexif
-from exif import Image
 from exif import DATETIME_STR_FORMAT
 from fractions import Fraction
 from datetime import datetime,timezone
@@ -15,15 +15,31 @@ import os
 import glob
 import io
 import re
-from pymp4.parser import Box
+import concurrent.futures
+import queue
+import threading
+import hashlib
+import json
+import csv
+import bisect
+import itertools
+import zipfile
+import time
+import contextlib
+import signal
+try:
+    import resource
+except ImportError:
+    resource = None
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--input', required = True, type=str) #input file or folder
+parser.add_argument('--input', type=str) #input file or folder, required unless --plan is given
 parser.add_argument('--sampling_interval', default = '0.5', type=float) #distance between images in seconds.
 parser.add_argument('--folder', default = 'output', type=str) #output folder, will be created if not exists
 parser.add_argument('--timeshift', default = '0', type=float) #time shift in seconds, if the gps and video seem out of sync
 parser.add_argument('--timezone', default = '0', type=float) #timezone difference in hours. Depends on video source, some provide GMT, others local
 parser.add_argument('--min_speed', default = '-1', type=float) #minimum speed in m/s to filter out stops
+parser.add_argument('--dedup_threshold', default = '-1', type=int) #skip frames whose 64 bit image hash differs from the last written one in at most this many bits, -1 to keep all. With --manifest the skipped frames are listed in <folder>/<video>_duplicates.txt for resuming
 parser.add_argument('--bearing_modifier', default = '0', type=float) #180 if rear camera
 parser.add_argument('--bearing_recalculate', default = '0', type=float) #should bearing be recalculated from trajectory
 parser.add_argument('--min_coverage', default = '90', type=int) #percentage - how much video must have GPS data in order to interpolate missing
@@ -37,16 +53,79 @@ parser.add_argument('--crop_left', default = '0', type=int) #number of pixels to
 parser.add_argument('--crop_right', default = '0', type=int) #number of pixels to crop from right
 parser.add_argument('--crop_top', default = '0', type=int) #number of pixels to crop from top
 parser.add_argument('--crop_bottom', default = '0', type=int) #number of pixels to crop from bottom
+parser.add_argument('--resize_width', default = '0', type=int) #scale wider images down to this width keeping the aspect ratio, overrides the output profile, 0 to use the profile width
+parser.add_argument('--rotate', default = '0', type=int, choices = [0, 90, 180, 270]) #rotate images clockwise by this many degrees
+parser.add_argument('--transforms', default = 'crop,mask,resize,rotate', type=str) #order of the image transforms, the mask always matches the video frame
+parser.add_argument('--output_profile', default = 'native', choices = ['native', 'archive', 'upload', 'small', 'webp'], type=str) #image size, format and encoder settings, see OUTPUT_PROFILES
 parser.add_argument('--make', type=str) #set camera make to be written in EXIF
 parser.add_argument('--model', type=str) #set camera model to be written in EXIF
-args = parser.parse_args()
-print(args)
-input_ts_file = args.input
-folder = args.folder
-timeshift = args.timeshift
-
-if args.mask:
-    mask = cv2.imread(args.mask,0)
+parser.add_argument('--jobs', default = '1', type=int) #number of input files processed in parallel when input is a folder
+parser.add_argument('--decode_mode', default = 'auto', choices = ['auto', 'seek', 'stream', 'gop'], type=str) #seek to every sampled frame, decode straight through, or gop to seek only into the next keyframe group, auto picks by sampling density
+parser.add_argument('--stream_max_gap', default = '2', type=float) #auto mode decodes straight through when sampled frames are on average at most this many seconds apart
+parser.add_argument('--encoder_threads', default = '2', type=int) #threads masking, cropping, encoding and writing frames while the next ones are decoded, 0 to do it inline
+parser.add_argument('--queue_depth', default = '8', type=int) #decoded frames waiting for an encoder thread, bounds memory use
+parser.add_argument('--cache', default = '1', type=int) #reuse results of earlier runs on unchanged files, 0 to disable
+parser.add_argument('--cache_dir', default = '', type=str) #where cached results are kept, defaults to .cache in the output folder
+parser.add_argument('--decoder', default = 'opencv', choices = ['opencv', 'pyav'], type=str) #video decoding backend, pyav needs the av package
+parser.add_argument('--decoder_threads', default = '0', type=int) #pyav decoding threads, 0 lets FFmpeg decide
+parser.add_argument('--skip_nonref', default = '0', type=int) #pyav only: do not decode frames no other frame refers to, samples on them get the next decoded frame
+parser.add_argument('--keyframes_only', default = '0', type=int) #move every sample to the nearest keyframe, pyav then decodes nothing else
+parser.add_argument('--manifest', default = '1', type=int) #record finished inputs in <folder>/manifest.jsonl, skip them and resume interrupted ones on the next run, 0 to always start over
+parser.add_argument('--profile', default = '0', type=int) #time every processing stage, print a table at the end and write the figures per input to <folder>/profile.json
+parser.add_argument('--plan_only', '--plan-only', default = '0', type=int) #only write <folder>/<video>_plan.csv with the frames and metadata that would be extracted, nothing is decoded
+parser.add_argument('--trip', default = '0', type=int) #1 to join the files of an input folder into trips ordered by time, one continuous track each, so distance spacing and image numbers go on across files. No manifest
+parser.add_argument('--trip_gap', default = '10', type=float) #seconds between the end of one file and the start of the next that start a new trip
+parser.add_argument('--watch', default = '0', type=int) #1 to keep watching the --input folder and process every new file once it stops growing, progress is kept in <folder>/watch_state.json, Ctrl+C to stop. A failed file is tried again only when it changes
+parser.add_argument('--watch_interval', default = '5', type=float) #seconds between two looks at the watched folder
+parser.add_argument('--watch_settle', default = '30', type=float) #seconds the size of a file must stay the same before it is processed
+parser.add_argument('--watch_attempts', default = '2', type=int) #times a file is started before it is marked failed, a crashed worker counts as an attempt of every file it had
+parser.add_argument('--plan', type=str) #extract the frames listed in a plan file (or a folder of them) written by --plan_only, --timezone, --mask and cropping still apply
+
+PLAN_COLUMNS = ("input", "frame_index", "ts", "lat", "lon", "bearing", "speed", "output_name", "make", "model")
+def cv2_params(*params):
+    #imencode parameters, names are looked up in cv2. None if this OpenCV build lacks one of them, the JPEG sampling factor needs 4.5.5
+    values = [getattr(cv2, param, None) if isinstance(param, str) else param for param in params]
+    return None if None in values else values
+
+#Output image settings, width 0 keeps the frame size. native is OpenCV's default JPEG. params None means the profile cannot be used with this OpenCV
+OUTPUT_PROFILES = {
+    "native": {"width": 0, "extension": ".jpg", "params": []},
+    "archive": {"width": 0, "extension": ".jpg", "params": cv2_params("IMWRITE_JPEG_QUALITY", 95, "IMWRITE_JPEG_SAMPLING_FACTOR", "IMWRITE_JPEG_SAMPLING_FACTOR_444", "IMWRITE_JPEG_OPTIMIZE", 1)},
+    "upload": {"width": 1920, "extension": ".jpg", "params": cv2_params("IMWRITE_JPEG_QUALITY", 85, "IMWRITE_JPEG_SAMPLING_FACTOR", "IMWRITE_JPEG_SAMPLING_FACTOR_420", "IMWRITE_JPEG_OPTIMIZE", 1, "IMWRITE_JPEG_PROGRESSIVE", 1)},
+    "small": {"width": 1280, "extension": ".jpg", "params": cv2_params("IMWRITE_JPEG_QUALITY", 75, "IMWRITE_JPEG_SAMPLING_FACTOR", "IMWRITE_JPEG_SAMPLING_FACTOR_420", "IMWRITE_JPEG_OPTIMIZE", 1, "IMWRITE_JPEG_PROGRESSIVE", 1)},
+    "webp": {"width": 1920, "extension": ".webp", "params": cv2_params("IMWRITE_WEBP_QUALITY", 80)},
+}
+#Options that change the extracted images, a finished input is only skipped if they are the same
+OUTPUT_PARAMS = ("sampling_interval", "timeshift", "timezone", "min_speed", "dedup_threshold", "bearing_modifier", "bearing_recalculate", "min_coverage", "min_points",
+                 "metric_distance", "device_override", "mask", "crop_left", "crop_right", "crop_top", "crop_bottom", "resize_width", "rotate", "transforms", "output_profile", "make", "model", "skip_nonref", "keyframes_only")
+
+args = None
+folder = 'output'
+timeshift = 0
+mask = None
+cache_dir = '.cache'
+manifest = {}
+pipeline = None
+profile = None
+profiler = None
+trip_profiles = {}
+
+def setup(run_args):
+    #Runs in the main process and once in every worker process of the --jobs pool
+    global args, folder, timeshift, mask, cache_dir, manifest, pipeline, profile, profiler, trip_profiles
+    args = run_args
+    folder = args.folder
+    cache_dir = args.cache_dir or os.path.join(folder, ".cache")
+    timeshift = args.timeshift
+    mask = None
+    if args.mask:
+        mask = cv2.imread(args.mask,0)
+    profile = OUTPUT_PROFILES[args.output_profile]
+    pipeline = FramePipeline(args.transforms.split(","), mask, args.resize_width or profile["width"])
+    manifest = read_manifest()
+    profiler = Profiler()
+    trip_profiles = {}
+
 # Define a context manager to suppress stdout and stderr.
 class suppress_stdout_stderr(object): #from here: https://stackoverflow.com/questions/11130156/suppress-stdout-stderr-print-from-python-functions
     '''
@@ -143,10 +222,147 @@ def change_to_rational(number):
     return (f.numerator, f.denominator)
 
 
-def set_gps_location(file_name, lat, lng, bear, make, model, datetm):
-    """Adds GPS position as EXIF metadata
+class Track(object):
+    '''
+    GPS points of one video. Point i is stored at position i of contiguous NumPy
+    arrays, one array per field, and valid tells which positions hold a point.
+    "i in track" and len(track) look only at valid points. Altitude and fix
+    quality come from NMEA GGA sentences and are NaN where unknown.
+    '''
+    POINT_FIELDS = ("ts", "lat", "lon", "mx", "my", "bearing", "speed", "alt", "fix")
+    FIELDS = POINT_FIELDS + ("metric", "prevdist")
+
+    def __init__(self, size = 0):
+        for name in self.FIELDS:
+            setattr(self, name, np.zeros(size))
+        self.valid = np.zeros(size, dtype=bool)
+
+    @classmethod
+    def from_points(cls, points, size):
+        '''
+        points -- list of (index, ts, lat, lon, bearing, speed) tuples
+        size -- number of point positions, at least the highest index + 1
+        '''
+        track = cls(size)
+        if points:
+            index, ts, lat, lon, bearing, speed = (np.array(column) for column in zip(*points))
+            track.set_points(index.astype(np.int64), ts, lat, lon, bearing, speed)
+        return track
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        rows -- iterable of (ts, lat, lon, bearing, speed, alt, fix) tuples, row i becomes point i
+        '''
+        columns = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64).reshape(-1, 7)
+        track = cls(len(columns))
+        if len(columns):
+            track.set_points(np.arange(len(columns)), *columns.T)
+        return track
+
+    @property
+    def size(self):
+        return len(self.valid)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.valid))
+
+    def __contains__(self, i):
+        return 0 <= i < len(self.valid) and bool(self.valid[int(i)])
+
+    def indices(self):
+        return np.flatnonzero(self.valid)
+
+    def resize(self, size):
+        #Grows or shrinks the track, new positions are empty
+        for name in self.FIELDS + ("valid",):
+            old = getattr(self, name)
+            new = np.zeros(size, dtype=old.dtype)
+            new[:min(size, len(old))] = old[:size]
+            setattr(self, name, new)
+
+    def section(self, start, end):
+        #Copy of positions start to end as a track of its own
+        track = Track()
+        for name in self.FIELDS + ("valid",):
+            setattr(track, name, getattr(self, name)[start:end].copy())
+        return track
+
+    def place(self, track, offset):
+        #Copies all positions of another track in, starting at offset
+        for name in self.FIELDS + ("valid",):
+            getattr(self, name)[offset:offset + track.size] = getattr(track, name)
+
+    def set_points(self, index, ts, lat, lon, bearing, speed, alt = np.nan, fix = np.nan):
+        self.ts[index] = ts
+        self.lat[index] = lat
+        self.lon[index] = lon
+        self.mx[index], self.my[index] = lonlat_metric(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        self.bearing[index] = bearing
+        self.speed[index] = speed
+        self.alt[index] = alt
+        self.fix[index] = fix
+        self.metric[index] = 0
+        self.prevdist[index] = 0
+        self.valid[index] = True
+
+    def interpolate_gaps(self):
+        #Fills every missing point between the first and the last valid one from its nearest valid
+        #neighbours. Bearing is interpolated on the circle, so 350 and 10 give 0, not 180.
+        #return: number of points filled
+        known = self.indices()
+        if len(known) < 2:
+            return 0
+        missing = np.flatnonzero(~self.valid[known[0]:known[-1]]) + known[0]
+        if len(missing) == 0:
+            return 0
+        for name in self.POINT_FIELDS:
+            values = getattr(self, name)
+            if name == "bearing":
+                values[missing] = np.interp(missing, known, np.unwrap(values[known], period=360)) % 360
+            else:
+                values[missing] = np.interp(missing, known, values[known])
+        self.mark_filled(missing)
+        return len(missing)
+
+    def extrapolate_edges(self, start, end):
+        #Continues the track in a straight line below its first point down to start,
+        #and above its last point up to end, using the slope of the two outermost points
+        known = self.indices()
+        if len(known) < 2:
+            return
+        for index, edge, inner in ((np.arange(start, known[0]), known[0], known[0] + 1), (np.arange(known[-1] + 1, min(end, self.size)), known[-1], known[-1] - 1)):
+            if len(index) == 0 or inner not in self:
+                continue
+            steps = np.abs(index - edge)
+            for name in self.POINT_FIELDS:
+                values = getattr(self, name)
+                slope = values[inner] - values[edge]
+                if name == "bearing":
+                    slope = (slope + 180) % 360 - 180
+                    values[index] = (values[edge] - slope * steps) % 360
+                else:
+                    values[index] = values[edge] - slope * steps
+            self.mark_filled(index)
+
+    def mark_filled(self, index):
+        self.metric[index] = 0
+        self.prevdist[index] = 0
+        self.valid[index] = True
+
+    def update_distances(self):
+        #Distance from the previous point and from the start, along the run of points starting at 0
+        if 0 not in self:
+            return
+        gaps = np.flatnonzero(~self.valid)
+        end = gaps[0] if len(gaps) else self.size
+        prevdist = np.cos(np.radians(self.lat[1:end])) * np.sqrt(np.square(self.mx[0:end-1] - self.mx[1:end]) + np.square(self.my[0:end-1] - self.my[1:end]))
+        self.prevdist[1:end] = prevdist
+        self.metric[1:end] = self.metric[0] + np.cumsum(prevdist)
+
+def get_exif_bytes(lat, lng, bear, make, model, datetm):
+    """Builds the EXIF block with GPS position, camera and time
     Keyword arguments:
-    file_name -- image file
     lat -- latitude (as float)
     lng -- longitude (as float)
     """
@@ -177,8 +393,93 @@ def set_gps_location(file_name, lat, lng, bear, make, model, datetm):
 
 
     exif_dict = {"0th":zeroth_ifd,"Exif":exif_ifd,"GPS": gps_ifd}
-    exif_bytes = piexif.dump(exif_dict)
-    piexif.insert(exif_bytes, file_name)
+    return piexif.dump(exif_dict)
+
+class Profiler(object):
+    '''
+    Wall time, number of calls and peak RSS of every pipeline stage, recorded with
+    "with profiler.stage(name):" or add(). Safe to use from the encoder threads.
+    A disabled profiler records nothing and costs next to nothing.
+    rss_scope tells what the peak covers: "input" where the peak can be reset (Linux),
+    so it starts from the size of the process when the profiler is made, else "process".
+    '''
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.rss_scope = None
+        if enabled:
+            self.rss_scope = "input" if reset_peak_rss() else "process"
+
+    def stage(self, name):
+        if not self.enabled:
+            return NO_STAGE
+        return ProfilerStage(self, name)
+
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        rss = peak_rss_mb()
+        with self.lock:
+            entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "peak_rss_mb": 0.0})
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], rss)
+
+class ProfilerStage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+NO_STAGE = contextlib.nullcontext()
+
+def reset_peak_rss():
+    #Linux only: the peak (VmHWM) starts again from the current resident set size. Returns False where that is not possible
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    #Highest resident set size of this process since start or since reset_peak_rss, 0 where the resource module is missing (Windows)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024 #kB
+    except OSError:
+        pass
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024 #bytes on macOS, KiB elsewhere
+
+def write_image(file_name, image, exif_bytes):
+    """Encodes the frame in memory with the output profile and writes it together with the EXIF block, touching the disk once.
+    Returns the file size and the encoding time in seconds
+    Keyword arguments:
+    file_name -- output image file
+    image -- frame as returned by OpenCV
+    exif_bytes -- output of get_exif_bytes
+    """
+    start = time.perf_counter()
+    success, encoded = cv2.imencode(profile["extension"], image, profile["params"])
+    encode_time = time.perf_counter() - start
+    profiler.add("encode", encode_time)
+    if not success:
+        raise ValueError("Encoding failed for " + file_name)
+    with profiler.stage("exif_write"):
+        piexif.insert(exif_bytes, encoded.tobytes(), file_name + ".part")
+        os.replace(file_name + ".part", file_name) #an existing output is always complete, a resumed run relies on it
+    return os.path.getsize(file_name), encode_time
 
 
 def fix_coordinates(hemisphere,coordinate_input): #From here: https://sergei.nz/extracting-gps-data-from-viofo-a119-and-other-novatek-powered-cameras/
@@ -203,9 +504,9 @@ def to_gps_latlon(v, refs):
     return (ref, r)    
 
 
-def lonlat_metric(xlon, xlat):
+def lonlat_metric(xlon, xlat): #works on single values and arrays
     mx = xlon * (2 * math.pi * 6378137 / 2.0) / 180.0
-    my = math.log( math.tan((90 + xlat) * math.pi / 360.0 )) / (math.pi / 180.0)
+    my = np.log( np.tan((90 + xlat) * math.pi / 360.0 )) / (math.pi / 180.0)
 
     my = my * (2 * math.pi * 6378137 / 2.0) / 180.0
     return mx, my
@@ -218,7 +519,198 @@ def metric_lonlat(xmx, ymy):
     xlat = 180 / math.pi * (2 * math.atan( math.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
     return xlon, xlat
 
+NOVATEK_GPS_MARKER = re.compile(b'freeGPS')
+GARMIN_GPS_MARKER = re.compile(b'\x00\x14\x50\x4E\x44\x4D\x00\x00\x00\x00')
+NEXTBASE_GPS_MARKER = re.compile(b'G[PNLAB]RMC')
+#GxRMC and GxGGA sentences of any talker (GP GPS, GN combined, GL GLONASS, GA Galileo, GB BeiDou), optionally after the [unix time] prefix of MP4 gps boxes.
+#Groups are prefix, body, kind and checksum. A sentence without checksum must end at a line break, one cut off at the end of the data is left out
+NMEA_SENTENCE = re.compile(rb"(?:\[(\d+)\])?\$(G[PNLAB](RMC|GGA),[^*$\r\n]*)(?:\*([0-9A-Fa-f]{2})|(?=[\r\n]))")
+NEXTBASE_DETECT_MARKER = re.compile(b'G[PNLAB]GGA')
+NMEA_GGA_MARKER = re.compile(rb'\$G[PNLAB]GGA')
+TS_LAT_HEMISPHERES = np.frombuffer(b'NS', dtype=np.uint8)
+TS_LON_HEMISPHERES = np.frombuffer(b'EW', dtype=np.uint8)
+GPS_CACHE_VERSION = 3 #raise whenever file type detection or a get_gps_data_* function changes what it returns, cached types and tracks are then found again
+SCAN_CHUNK_SIZE = 16 * 1024 * 1024
+MP4_GPS_PARENTS = (b"free", b"moov") #top level boxes that are loaded to look for gps boxes in them
+
+def scan_file(f, pattern, before = 0, after = 0, chunk_size = None):
+    """Finds a pattern in a file of any size, reading it in overlapping fixed-size chunks
+    Keyword arguments:
+    f -- file opened in binary mode
+    pattern -- compiled bytes regular expression
+    before, after -- how many bytes before and after the start of each match to return with it
+    return: generator of (file offset of match, bytes from offset-before to offset+after)
+    """
+    chunk_size = chunk_size or SCAN_CHUNK_SIZE
+    overlap = after + len(pattern.pattern)
+    f.seek(0, io.SEEK_END)
+    eof = f.tell()
+    base = 0
+    while base < eof:
+        start = max(0, base - before)
+        f.seek(start)
+        data = f.read(base - start + chunk_size + overlap)
+        for m in pattern.finditer(data, base - start):
+            if m.start() >= base - start + chunk_size:
+                break #found again in the next chunk
+            yield start + m.start(), data[max(0, m.start() - before):m.start() + after]
+        base += chunk_size
+
+def mp4_boxes(f, end = None):
+    """Walks MP4 boxes reading only their 8 or 16 byte headers, payloads are seeked over
+    Keyword arguments:
+    f -- file opened in binary mode, or a BytesIO of a box payload, positioned at the first box
+    end -- offset where the boxes end, the end of the file if not given
+    return: generator of (box type, payload offset, payload size), a truncated or broken box ends the walk
+    """
+    if end is None:
+        f.seek(0, io.SEEK_END)
+        end = f.tell()
+        f.seek(0)
+    offset = f.tell()
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1: #64 bit size follows the type
+            header = 16
+            size, = struct.unpack(">Q", f.read(8))
+        elif size == 0: #box runs to the end
+            size = end - offset
+        if size < header or offset + size > end:
+            break
+        yield box_type, offset + header, size - header
+        offset += size
+
+def mp4_gps_boxes(f):
+    """Payloads of the top level gps box and of gps boxes inside top level free and moov boxes.
+    Only the headers of other boxes, mdat among them, are read
+    return: generator of (parent box type or None for a top level box, gps box payload)
+    """
+    for box_type, offset, size in mp4_boxes(f):
+        if box_type not in MP4_GPS_PARENTS and box_type != b"gps ":
+            continue
+        f.seek(offset)
+        payload = f.read(size)
+        if box_type == b"gps ":
+            yield None, payload
+            continue
+        for child_type, child_offset, child_size in mp4_boxes(io.BytesIO(payload)):
+            if child_type == b"gps ":
+                yield box_type, payload[child_offset:child_offset + child_size]
+
+def file_identity(input_file):
+    #Cached results are only valid for the same file with the same size and modification time
+    stat = os.stat(input_file)
+    return {"path": os.path.abspath(input_file), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def get_cache_file(input_file, suffix):
+    name = hashlib.sha1(os.path.abspath(input_file).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, name + suffix)
+
+def read_cache(input_file, suffix, key):
+    #Returns the cached value, or None if there is none for this file and key
+    if not args.cache:
+        return None
+    try:
+        with open(get_cache_file(input_file, suffix), "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get("identity") != file_identity(input_file) or entry.get("key") != key:
+        return None
+    return entry.get("value")
+
+def write_cache(input_file, suffix, key, value):
+    if not args.cache:
+        return
+    os.makedirs(cache_dir, exist_ok = True)
+    cache_file = get_cache_file(input_file, suffix)
+    with open(cache_file + ".%d.tmp" % os.getpid(), "w") as f:
+        json.dump({"identity": file_identity(input_file), "key": key, "value": value}, f)
+    os.replace(cache_file + ".%d.tmp" % os.getpid(), cache_file)
+
+def quick_hash(input_file):
+    #sha1 of the size and the first and last MiB, tells a copied file from a different one without reading it all
+    h = hashlib.sha1()
+    with open(input_file, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        h.update(str(size).encode("ascii"))
+        f.seek(0)
+        h.update(f.read(1 << 20))
+        f.seek(max(0, size - (1 << 20)))
+        h.update(f.read(1 << 20))
+    return h.hexdigest()
+
+def get_manifest_file():
+    return os.path.join(folder, "manifest.jsonl")
+
+def read_manifest():
+    #Latest manifest entry of every input, the file is only ever appended to
+    entries = {}
+    if not args.manifest:
+        return entries
+    try:
+        with open(get_manifest_file(), "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue #line cut short by a crash
+                entries[entry["file"]] = entry
+    except OSError:
+        pass
+    return entries
+
+def append_manifest(entry):
+    if not args.manifest:
+        return
+    with open(get_manifest_file(), "a") as f:
+        f.write(json.dumps(entry) + "\n") #one write per line, so --jobs workers do not interleave
+
+def get_track_cache_key(input_file):
+    return {"identity": file_identity(input_file), "version": GPS_CACHE_VERSION, "device_override": args.device_override}
+
+def read_track_cache(input_file):
+    #Returns (device, make, model, track) as parsed by an earlier run, or None
+    if not args.cache:
+        return None
+    try:
+        with np.load(get_cache_file(input_file, ".track.npz"), allow_pickle = False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["key"] != get_track_cache_key(input_file):
+                return None
+            track = Track(len(data["valid"]))
+            for name in Track.POINT_FIELDS + ("valid",):
+                setattr(track, name, data[name])
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+    device,make,model = meta["device"]
+    return device,make,model,track
+
+def write_track_cache(input_file, device, make, model, track):
+    #Keeps the track before interpolation, so later runs with other settings skip detection and parsing
+    if not args.cache:
+        return
+    os.makedirs(cache_dir, exist_ok = True)
+    cache_file = get_cache_file(input_file, ".track.npz")
+    meta = {"key": get_track_cache_key(input_file), "device": [device, make, model]}
+    with open(cache_file + ".%d.tmp" % os.getpid(), "wb") as f:
+        np.savez_compressed(f, meta = np.array(json.dumps(meta)), **{name: getattr(track, name) for name in Track.POINT_FIELDS + ("valid",)})
+    os.replace(cache_file + ".%d.tmp" % os.getpid(), cache_file)
+
 def detect_file_type(input_file):
+    key = {"version": GPS_CACHE_VERSION, "device_override": args.device_override}
+    cached = read_cache(input_file, ".type.json", key)
+    if cached:
+        device,make,model = cached
+        print ("File type from cache")
+    else:
+        device,make,model = sniff_file_type(input_file)
+        write_cache(input_file, ".type.json", key, [device,make,model])
+    return device,make,model
+
+def sniff_file_type(input_file):
     device = "X"
     make = "unknown"
     model = "unknown"
@@ -237,128 +729,101 @@ def detect_file_type(input_file):
                 model = "B4K"
                
             while device == "A":
-                currentdata = {}
-                input_packet = f.read(188)
-                if not input_packet:
+                #Autodetect camera type, looking at a few thousand packets at a time
+                chunk = f.read(188 * 4096)
+                if len(chunk) < 188:
                     break
-                
-                #Autodetect camera type
-                if device == 'A' and input_packet.startswith(bytes("\x47\x03\x00", encoding="raw_unicode_escape")):
-                    bs = list(input_packet)
-                    active = chr(bs[156])
-                    lathem = chr(bs[157])
-                    lonhem = chr(bs[158])
-                    if lathem in "NS" and lonhem in "EW":
-                        device = "B"
-                        make = "Blueskysea"
-                        model = "B4K"
-                        print ("Autodetected as Blueskysea B4K")
-                        break
-                    
-                if device == 'A' and input_packet.startswith(bytes("\x47\x43\x00", encoding="raw_unicode_escape")):
-                    bs = list(input_packet)
-                    active = chr(bs[34])
-                    lathem = chr(bs[35])
-                    lonhem = chr(bs[36])            
-                    if lathem in "NS" and lonhem in "EW":
-                        device = "V"
-                        print ("Autodetected as Viofo A119 V3")
-                        make = "Viofo"
-                        model = "A119 V3"
-                        break
+                packets = np.frombuffer(chunk, dtype=np.uint8, count=len(chunk) // 188 * 188).reshape(-1, 188)
+                header = (packets[:, 0] == 0x47) & (packets[:, 2] == 0x00)
+                b4k = header & (packets[:, 1] == 0x03) & np.isin(packets[:, 157], TS_LAT_HEMISPHERES) & np.isin(packets[:, 158], TS_LON_HEMISPHERES)
+                viofo = header & (packets[:, 1] == 0x43) & np.isin(packets[:, 35], TS_LAT_HEMISPHERES) & np.isin(packets[:, 36], TS_LON_HEMISPHERES)
+                found = np.flatnonzero(b4k | viofo)
+                if len(found) == 0:
+                    continue
+                if b4k[found[0]]:
+                    device = "B"
+                    make = "Blueskysea"
+                    model = "B4K"
+                    print ("Autodetected as Blueskysea B4K")
+                else:
+                    device = "V"
+                    print ("Autodetected as Viofo A119 V3")
+                    make = "Viofo"
+                    model = "A119 V3"
     if input_file.lower().endswith(".mp4"): #Guess which MP4 method is used: Novatek, Subtitle, NMEA
         with open(input_file, "rb") as fx:
-            
-            if True:
-                fx.seek(0, io.SEEK_END)
-                eof = fx.tell()
-                fx.seek(0)
-                lines = []
-                while fx.tell() < eof:
-                    try:
-                        box = Box.parse_stream(fx)
-                    except:
-                        pass
-                    #print (box.type.decode("utf-8"))
-                    if box.type.decode("utf-8") == "free":
-                        length = len(box.data)
-                        offset = 0
-                        while offset < length:
-                            inp = Box.parse(box.data[offset:])
-                            #print (inp.type.decode("utf-8"))
-                            if inp.type.decode("utf-8") == "gps": #NMEA-based
-                                lines = inp.data
-                                for line in lines.splitlines():
-                                    m = str(line).lstrip("[]0123456789")
-                                    if "$GPGGA" in m:
-                                        device = "N"
-                                        make = "NMEA-based video"
-                                        model = "unknown"
-                                        break
-                            offset += inp.end
-                    if box.type.decode("utf-8") == "gps": #has Novatek-specific stuff
-                        fx.seek(0)
-                        largeelem = fx.read()
-                        startbytes = [m.start() for m in re.finditer(b'freeGPS', largeelem)]
-                        del largeelem
-                        if len(startbytes)>0:
-                            make = "Novatek"
-                            model = "MP4"
-                            device = "T"
-                            break
-                        
-                    if box.type.decode("utf-8") == "moov":
-                        try:
-                            length = len(box.data)
-                        except:
-                            length = 0
-                        offset = 0
-                        while offset < length:
-                            inp = Box.parse(box.data[offset:])
-                            #print (inp.type.decode("utf-8"))
-                            if inp.type.decode("utf-8") == "gps": #NMEA-based
-                                lines = inp.data
-                                print (len(inp.data))
-                                for line in lines.splitlines():
-                                    m = str(line).lstrip("[]0123456789")
-                                    if "$GPGGA" in m:
-                                        device = "N"
-                                        make = "NMEA-based video"
-                                        model = "unknown"
-                                        #break
-                            offset += inp.end
-            else:
-                pass
-            if device == "X":
-                fx.seek(0)
-                largeelem = fx.read()
-                startbytes = [m.start() for m in re.finditer(b'\x00\x14\x50\x4E\x44\x4D\x00\x00\x00\x00', largeelem)]
-                del largeelem
-                if len(startbytes)>0:
-                    make = "Garmin"
-                    model = "unknown"
-                    device = "G"
-            if device == "X":
-                fx.seek(0)
-                largeelem = fx.read()
-                startbytes = [m.start() for m in re.finditer(b'GPGGA', largeelem)]
-                
-                del largeelem
-                if len(startbytes)>0:
-                    make = "NEXTBASE"
+            has_gps_box = False
+            for parent, payload in mp4_gps_boxes(fx):
+                if parent is None: #has Novatek-specific stuff
+                    has_gps_box = True
+                    break
+                if NMEA_GGA_MARKER.search(payload): #NMEA-based
+                    device = "N"
+                    make = "NMEA-based video"
                     model = "unknown"
-                    device = "NB"       
+            #Look for the remaining signatures in a single pass, highest priority first.
+            #The scan stops as soon as the signature that wins over all others is found.
+            found = set()
+            if device != "N" and next(read_novatek_blocks(fx, novatek_gps_table(fx)[:1]), None) is not None:
+                found.add(NOVATEK_GPS_MARKER) #a gps box lists freeGPS blocks, no need to scan for them
+            wanted = []
+            if has_gps_box and not found:
+                wanted.append(NOVATEK_GPS_MARKER)
+            if device == "X" and not found:
+                wanted.extend([GARMIN_GPS_MARKER, NEXTBASE_DETECT_MARKER])
+            if wanted:
+                signatures = re.compile(b"|".join(b"(?:" + marker.pattern + b")" for marker in wanted))
+                for startbyte, window in scan_file(fx, signatures, after = max(len(marker.pattern) for marker in wanted)):
+                    found.update(marker for marker in wanted if marker.match(window))
+                    if wanted[0] in found:
+                        break
+            if NOVATEK_GPS_MARKER in found:
+                make = "Novatek"
+                model = "MP4"
+                device = "T"
+            elif GARMIN_GPS_MARKER in found:
+                make = "Garmin"
+                model = "unknown"
+                device = "G"
+            elif NEXTBASE_DETECT_MARKER in found:
+                make = "NEXTBASE"
+                model = "unknown"
+                device = "NB"       
     return device,make,model
     
+def novatek_gps_table(f):
+    """Novatek cameras list their GPS blocks in a gps box at the top level or inside moov:
+    two 32 bit words, the second one the entry count, then a big endian (offset, size) pair per block
+    return: list of [offset, size] of the blocks, empty if there is no table
+    """
+    for parent, payload in mp4_gps_boxes(f):
+        if parent == b"free" or len(payload) < 16 or NMEA_SENTENCE.search(payload):
+            continue
+        count, = struct.unpack_from(">I", payload, 4)
+        count = min(count, (len(payload) - 8) // 8)
+        entries = np.frombuffer(payload, dtype=">u4", count = count * 2, offset = 8).reshape(-1, 2)
+        entries = entries[(entries[:, 0] > 0) & (entries[:, 1] > 0)] #cameras reserve the table and leave unused entries zero
+        if len(entries):
+            return entries.tolist()
+    return []
+
+def read_novatek_blocks(f, table):
+    #Reads only the listed blocks, the freeGPS marker follows the 4 byte block size
+    for offset, size in table:
+        f.seek(offset + 4)
+        window = f.read(188)
+        if NOVATEK_GPS_MARKER.match(window):
+            yield offset + 4, window
+
 def get_gps_data_nt (input_ts_file, device):
     packetno = 0
-    locdata = {}
+    points = []
     with open(input_ts_file, "rb") as f:
-        largeelem = f.read()
-        startbytes = [m.start() for m in re.finditer(b'freeGPS', largeelem)]
-        for startbyte in startbytes:
-            currentdata = {}
-            input_packet = largeelem[startbyte+2:startbyte+188]
+        blocks = list(read_novatek_blocks(f, novatek_gps_table(f)))
+        if not blocks: #no table, or it does not point at GPS blocks
+            blocks = scan_file(f, NOVATEK_GPS_MARKER, after = 188)
+        for startbyte, window in blocks:
+            input_packet = window[2:188]
             bs = list(input_packet)
             hour = int.from_bytes(input_packet[10:14], byteorder='little')
             minute = int.from_bytes(input_packet[14:18], byteorder='little')
@@ -374,34 +839,19 @@ def get_gps_data_nt (input_ts_file, device):
             speed_knots, = struct.unpack('<f', input_packet[46:50])
             speed = speed_knots * 1.6 / 3.6
             bearing, = struct.unpack('<f', input_packet[50:54])
-            currentdata["ts"] = datetime(year=2000+year, month=month, day=day, hour=hour, minute=minute, second=second).replace(tzinfo=timezone.utc).timestamp()
-            currentdata["lat"] = lat
-            currentdata["latR"] = lathem
-            currentdata["lon"] = lon
-            currentdata["lonR"] = lonhem
-            currentdata["bearing"] = bearing
-            currentdata["speed"] = speed
-            currentdata["mx"],currentdata["my"] = lonlat_metric(lon,lat)
-            currentdata["metric"] = 0
-            currentdata["prevdist"] = 0
+            ts = datetime(year=2000+year, month=month, day=day, hour=hour, minute=minute, second=second).replace(tzinfo=timezone.utc).timestamp()
             if active == "A":
-                locdata[packetno] = currentdata
+                points.append((packetno, ts, lat, lon, bearing, speed))
             packetno += 1
             #print ('20{0:02}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(year,month,day,hour,minute,second),active,lathem,lonhem,lat,lon,speed,bearing, sep=';')
-        
-            del currentdata
-    del largeelem
-    return locdata, packetno 
+    return Track.from_points(points, packetno)
 
 def get_gps_data_garmin (input_ts_file, device):
     packetno = 0
-    locdata = {}
+    points = []
     with open(input_ts_file, "rb") as f:
-        largeelem = f.read()
-        startbytes = [m.start() for m in re.finditer(b'\x00\x14\x50\x4E\x44\x4D\x00\x00\x00\x00', largeelem)]
-        for startbyte in startbytes:
-            currentdata = {}
-            input_packet = largeelem[startbyte:startbyte+56]
+        for startbyte, window in scan_file(f, GARMIN_GPS_MARKER, after = 56):
+            input_packet = window
             bs = list(input_packet)
             active = 0
             lathem = 0
@@ -411,271 +861,601 @@ def get_gps_data_garmin (input_ts_file, device):
             speed_knots = float(int.from_bytes(input_packet[10:11], byteorder='big'))
             speed = speed_knots * 1.6 / 3.6
             bearing = 0 #struct.unpack('<f', input_packet[50:54])
-            currentdata["ts"] = 0 #datetime(year=2000+year, month=month, day=day, hour=hour, minute=minute, second=second).replace(tzinfo=timezone.utc).timestamp()
-            currentdata["lat"] = lat
-            currentdata["latR"] = lathem
-            currentdata["lon"] = lon
-            currentdata["lonR"] = lonhem
-            currentdata["bearing"] = bearing
-            currentdata["speed"] = speed
-            currentdata["mx"],currentdata["my"] = lonlat_metric(lon,lat)
-            currentdata["metric"] = 0
-            currentdata["prevdist"] = 0
-            locdata[packetno] = currentdata
+            ts = 0 #datetime(year=2000+year, month=month, day=day, hour=hour, minute=minute, second=second).replace(tzinfo=timezone.utc).timestamp()
+            points.append((packetno, ts, lat, lon, bearing, speed))
             packetno += 1
             #print (0,active,lathem,lonhem,lat,lon,speed,bearing, sep=';')
-        
-            del currentdata
-    del largeelem
-    return locdata, packetno 
+    return Track.from_points(points, packetno)
+
+def read_nmea(lines):
+    """Streaming NMEA tokenizer, every sentence is split once
+    lines -- iterable of bytes holding one or more sentences each
+    return: generator of (kind, fields, prefix) for every GxRMC and GxGGA sentence whose checksum is right or missing,
+            kind is b"RMC" or b"GGA", fields the values after the sentence name, prefix the [unix time] or b""
+    """
+    for line in lines:
+        sentences = NMEA_SENTENCE.findall(line)
+        if not sentences:
+            continue
+        #checksums of all sentences of the chunk in one NumPy call, each is the XOR of the bytes of its body
+        bodies = [sentence[1] for sentence in sentences]
+        lengths = np.fromiter(map(len, bodies), dtype=np.int64, count=len(bodies))
+        starts = np.concatenate(([0], np.cumsum(lengths[:-1])))
+        checksums = np.bitwise_xor.reduceat(np.frombuffer(b"".join(bodies), dtype=np.uint8), starts).tolist()
+        for (prefix, body, kind, expected), checksum in zip(sentences, checksums):
+            if expected and int(expected, 16) != checksum:
+                continue
+            yield kind, body.split(b",")[1:], prefix
+
+def nmea_coordinate(value, hemisphere):
+    #ddmm.mmmm or dddmm.mmmm to signed degrees
+    point = value.find(b".")
+    degrees = (point if point >= 0 else len(value)) - 2
+    coordinate = float(value[:degrees]) + float(value[degrees:]) / 60
+    return -coordinate if hemisphere in (b"S", b"W") else coordinate
+
+def nmea_utc_timestamp(fields):
+    #RMC time and date fields as seconds since epoch
+    return datetime.strptime((fields[8] + fields[0][:6]).decode("ascii"), "%d%m%y%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+
+def nmea_gga_values(fields):
+    #altitude and fix quality of a GGA sentence
+    try:
+        return float(fields[8]) if fields[8] else np.nan, float(fields[5]) if fields[5] else np.nan
+    except (ValueError, IndexError):
+        return np.nan, np.nan
+
+def nmea_points(sentences, timestamp):
+    """Turns sentences into points, a GGA sentence with the same time as an RMC one adds altitude and fix quality to it
+    sentences -- (kind, fields, context) tuples as returned by read_nmea
+    timestamp -- function(context, fields) giving the time of an RMC sentence, context is the third item of the sentence tuple
+    return: generator of (ts, lat, lon, bearing, speed, alt, fix) for every RMC with an active fix and a later time than the point before
+    """
+    point = None
+    point_gga = None
+    point_gga_time = None
+    last_gga = None
+    prevts = None
+    for kind, fields, context in sentences:
+        if kind == b"GGA":
+            #the GGA of a point may come before or after its RMC
+            if fields[0] == point_gga_time:
+                point_gga = fields
+            else:
+                last_gga = fields
+            continue
+        try:
+            if fields[1] != b"A":
+                continue
+            ts = timestamp(context, fields)
+            lat = nmea_coordinate(fields[2], fields[3])
+            lon = nmea_coordinate(fields[4], fields[5])
+        except (ValueError, IndexError):
+            continue
+        if prevts is not None and ts <= prevts:
+            continue
+        prevts = ts
+        try:
+            speed = float(fields[6])*1.6/3.6
+            bearing = float(fields[7]) if fields[7] else 0
+        except (ValueError, IndexError):
+            speed = 0
+            bearing = 0
+        if point is not None:
+            yield point + (nmea_gga_values(point_gga) if point_gga else (np.nan, np.nan))
+        point = (ts, lat, lon, bearing, speed)
+        point_gga_time = fields[0]
+        point_gga = last_gga if last_gga is not None and last_gga[0] == point_gga_time else None
+    if point is not None:
+        yield point + (nmea_gga_values(point_gga) if point_gga else (np.nan, np.nan))
 
 def get_gps_data_nextbase (input_ts_file, device):
-    print (1)
-    packetno = 0
-    locdata = {}
-    prevts = -1
+    #Every RMC sentence follows 28 bytes after a local time stamp written as text, yyyymmddHHMMSS, and is followed by its GGA sentence
+    def sentences(f):
+        for startbyte, window in scan_file(f, NEXTBASE_GPS_MARKER, before = 29, after = 200):
+            if startbyte < 29:
+                continue #no room for the timestamp
+            rmc = 0
+            for kind, fields, prefix in read_nmea((window[28:],)):
+                rmc += kind == b"RMC"
+                if rmc > 1:
+                    break #the next record, read with its own time stamp
+                yield kind, fields, window
+
+    def timestamp(window, fields):
+        return datetime.strptime(window[0:14].decode("utf-8"), "%Y%m%d%H%M%S").timestamp()
+
     with open(input_ts_file, "rb") as f:
-        largeelem = f.read()
-        startbytes = [m.start() for m in re.finditer(b'GPRMC', largeelem)]
-        for startbyte in startbytes:
-            currentdata = {}
-            input_packet = largeelem[startbyte-1:startbyte+100]
-            m = str(input_packet)
-            #print (m)
-            if "$GPRMC" in m:
-                currentdata = {}
-                currentdata["ts"] = datetime.strptime(largeelem[startbyte-29:startbyte-15].decode("utf-8"), "%Y%m%d%H%M%S").timestamp()
-                try:
-                    currentdata["lat"] = float(m.split(",")[3][0:2]) + float(m.split(",")[3][2:]) / 60
-                    currentdata["latR"] = m.split(",")[4]
-                    if currentdata["latR"] == "S":
-                        currentdata["lat"] = - currentdata["lat"]
-                    
-                    currentdata["lon"] = float(m.split(",")[5][0:3]) + float(m.split(",")[5][3:]) / 60
-                    currentdata["lonR"] = m.split(",")[6]
-                    if currentdata["lonR"] == "N":
-                        currentdata["lon"] = - currentdata["lon"]
-                except:
-                    pass
-                try:
-                    currentdata["bearing"] = float(m.split(",")[9])
-                    currentdata["speed"] = float(m.split(",")[8])*1.6/3.6
-                    
-                except:
-                    currentdata["bearing"] = 0
-                    currentdata["speed"] = 0
-                active = (m.split(",")[2])
-                nts = currentdata["ts"]
-                
-                currentdata["metric"] = 0
-                currentdata["prevdist"] = 0
-                try:
-                    currentdata["mx"],currentdata["my"] = lonlat_metric(currentdata["lon"],currentdata["lat"])
-                except:
-                    pass
-
-                if active == "A" and nts > prevts:
-                    locdata[packetno] = currentdata
-                    prevts = nts
-                    packetno += 1
-                
-                
-            #print (0,active,lathem,lonhem,lat,lon,speed,bearing, sep=';')
-        
-            del currentdata
-    del largeelem
-    return locdata, packetno 
+        return Track.from_rows(nmea_points(sentences(f), timestamp))
 
-def get_gps_data_nmea (input_file, device):
-    packetno = 0
-    locdata = {}
+def read_gps_box_lines(input_file):
+    #Payloads of the gps boxes inside top level free boxes
     with open(input_file, "rb") as fx:
-        if True:
-            fx.seek(0, io.SEEK_END)
-            eof = fx.tell()
-            fx.seek(0)
-            prevts = 0
-            lines = []
-            while fx.tell() < eof:
-                try:
-                    box = Box.parse_stream(fx)
-                except:
-                    pass
-                if box.type.decode("utf-8") == "free":
-                    try:
-                        length = len(box.data)
-                    except:
-                        length = 0
-                    offset = 0
-                    while offset < length:
-                        inp = Box.parse(box.data[offset:])
-                        #print (inp.type.decode("utf-8"))
-                        if inp.type.decode("utf-8") == "gps": #NMEA-based
-                            
-                            lines = inp.data
-                            
-                            for line in lines.splitlines():
-                                m = str(line)
-                                if "$GPRMC" in m:
-                                    currentdata = {}
-                                    currentdata["ts"] = int(m[3:13])
-                                    #print (m)
-                                    try:
-                                        currentdata["lat"] = float(m.split(",")[3][0:2]) + float(m.split(",")[3][2:]) / 60
-                                        currentdata["latR"] = m.split(",")[4]
-                                        if currentdata["latR"] == "S":
-                                            currentdata["lat"] = - currentdata["lat"]
-                                        
-                                        currentdata["lon"] = float(m.split(",")[5][0:3]) + float(m.split(",")[5][3:]) / 60
-                                        currentdata["lonR"] = m.split(",")[6]
-                                        if currentdata["lonR"] == "N":
-                                            currentdata["lon"] = - currentdata["lon"]
-                                    except:
-                                        pass
-                                    try:
-                                        currentdata["bearing"] = float(m.split(",")[9])
-                                        currentdata["speed"] = float(m.split(",")[8])*1.6/3.6
-                                        
-                                    except:
-                                        currentdata["bearing"] = 0
-                                        currentdata["speed"] = 0
-                                    active = (m.split(",")[2])
-                                    nts = currentdata["ts"]
-                                    
-                                    currentdata["metric"] = 0
-                                    currentdata["prevdist"] = 0
-                                    try:
-                                        currentdata["mx"],currentdata["my"] = lonlat_metric(currentdata["lon"],currentdata["lat"])
-                                    except:
-                                        pass
-
-                                    if active == "A" and nts > prevts:
-                                        locdata[packetno] = currentdata
-                                        prevts = nts
-                                        packetno += 1
-                                    
-                                    del currentdata
-                        offset += inp.end
-    return locdata, packetno 
+        for parent, payload in mp4_gps_boxes(fx):
+            if parent == b"free":
+                yield payload
+
+def get_gps_data_nmea (input_file, device):
+    #Lines are [unix time]$GPRMC,... where the prefix is missing the time comes from the sentence
+    def timestamp(prefix, fields):
+        if prefix:
+            return int(prefix)
+        return nmea_utc_timestamp(fields)
 
+    return Track.from_rows(nmea_points(read_nmea(read_gps_box_lines(input_file)), timestamp))
     
+#Field layout of the GPS packets inside 188-byte TS packets. Viofo packets start with 47 43 00,
+#Blueskysea B4K packets start with 47 03 00 and keep the time in the tail of the previous packet
+VIOFO_PACKET = np.dtype({
+    'names': ['hour','minute','second','year','month','day','active','lathem','lonhem','lat','lon','speed','bearing'],
+    'formats': ['<u4','<u4','<u4','<u4','<u4','<u4','S1','S1','S1','<f4','<f4','<f4','<f4'],
+    'offsets': [10,14,18,22,26,30,34,35,36,38,42,46,50],
+    'itemsize': 188})
+B4K_PACKET = np.dtype({
+    'names': ['year_high','month','day','active','lathem','lonhem','lat','lon','speed','bearing'],
+    'formats': ['<u2','<u4','<u4','S1','S1','S1','<f4','<f4','<f4','<f4'],
+    'offsets': [146,148,152,156,157,158,160,164,168,172],
+    'itemsize': 188})
+B4K_PREVIOUS_PACKET = np.dtype({
+    'names': ['hour','minute','second','year_low'],
+    'formats': ['<u4','<u4','<u4','<u2'],
+    'offsets': [174,178,182,186],
+    'itemsize': 188})
+
+def fix_coordinates_array(hemisphere, coordinate):
+    #Same as fix_coordinates, for whole arrays
+    coordinate = coordinate.astype(np.float64)
+    minutes = coordinate % 100.0
+    degrees = coordinate - minutes
+    coordinate = degrees / 100.0 + (minutes / 60.0)
+    return np.where((hemisphere == b'S') | (hemisphere == b'W'), -coordinate, coordinate)
+
+def utc_timestamp_array(year, month, day, hour, minute, second):
+    #Seconds since epoch for arrays of UTC date parts, days counted as in http://howardhinnant.github.io/date_algorithms.html
+    year = year.astype(np.int64) - (month <= 2)
+    month = month.astype(np.int64)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+    return (days * 86400 + hour.astype(np.int64) * 3600 + minute * 60 + second).astype(np.float64)
+
+def read_ts_gps_packets(input_ts_file, device, first_packet = 1):
+    """Finds all GPS packets of a TS file at once and decodes them into arrays
+    Keyword arguments:
+    device -- B for Blueskysea B4K, V for Viofo
+    first_packet -- packets before this one are not read
+    return: dict of field arrays, one element per GPS packet, inactive ones included
+    """
+    packet_count = os.path.getsize(input_ts_file) // 188
+    if device == 'B':
+        first_packet += 1 #B4K packets need the previous packet too
+    if packet_count <= first_packet:
+        index = np.zeros(0, dtype=np.int64)
+    else:
+        packets = np.memmap(input_ts_file, dtype=np.uint8, mode='r', shape=(packet_count, 188))
+        header = b"\x47\x03\x00" if device == 'B' else b"\x47\x43\x00"
+        selected = (packets[:, 0] == header[0]) & (packets[:, 1] == header[1]) & (packets[:, 2] == header[2])
+        selected[:first_packet] = False
+        index = np.flatnonzero(selected)
+    if device == 'B':
+        if len(index):
+            current = np.ascontiguousarray(packets[index]).view(B4K_PACKET)[:, 0]
+            previous = np.ascontiguousarray(packets[index - 1]).view(B4K_PREVIOUS_PACKET)[:, 0]
+        else:
+            current = np.zeros(0, dtype=B4K_PACKET)
+            previous = np.zeros(0, dtype=B4K_PREVIOUS_PACKET)
+        year = previous['year_low'].astype(np.uint32) | (current['year_high'].astype(np.uint32) << 16)
+        fields = {"hour": previous['hour'], "minute": previous['minute'], "second": previous['second'], "year": year}
+    else:
+        if len(index):
+            current = np.ascontiguousarray(packets[index]).view(VIOFO_PACKET)[:, 0]
+        else:
+            current = np.zeros(0, dtype=VIOFO_PACKET)
+        fields = {"hour": current['hour'], "minute": current['minute'], "second": current['second'], "year": current['year']}
+    fields["month"] = current['month']
+    fields["day"] = current['day']
+    fields["active"] = current['active']
+    fields["lathem"] = current['lathem']
+    fields["lonhem"] = current['lonhem']
+    fields["lat"] = fix_coordinates_array(current['lathem'], current['lat'])
+    fields["lon"] = fix_coordinates_array(current['lonhem'], current['lon'])
+    fields["speed"] = current['speed'].astype(np.float64) * 1.6 / 3.6
+    fields["bearing"] = current['bearing'].astype(np.float64)
+    return fields
+
 def get_gps_data_ts (input_ts_file, device):
-    packetno = 0
-    locdata = {}
-    prevpacket = None
-    with open(input_ts_file, "rb") as f:
-        input_packet = f.read(188) #First packet, try to autodetect
+    gps = read_ts_gps_packets(input_ts_file, device)
+    track = Track(len(gps["active"]))
+    timestamps = utc_timestamp_array(gps["year"] + 2000, gps["month"], gps["day"], gps["hour"], gps["minute"], gps["second"])
+    active = gps["active"] == b"A"
+    track.set_points(np.flatnonzero(active), timestamps[active], gps["lat"][active], gps["lon"][active], gps["bearing"][active], gps["speed"][active])
+    return track
+
+GPS_PARSERS = {"B": get_gps_data_ts, "V": get_gps_data_ts, "T": get_gps_data_nt, "N": get_gps_data_nmea, "G": get_gps_data_garmin, "NB": get_gps_data_nextbase}
+
+def get_gps_data(input_ts_file):
+    """Detects the file type and parses the GPS track, an unchanged file gets both from the cache"""
+    with profiler.stage("gps_cache"):
+        cached = read_track_cache(input_ts_file)
+    if cached:
+        print ("GPS data from cache")
+        return cached
+    with profiler.stage("detect"):
+        device,make,model = detect_file_type(input_ts_file)
+    track = Track()
+    if device in GPS_PARSERS:
+        with profiler.stage("parse"):
+            track = GPS_PARSERS[device](input_ts_file, device)
+    write_track_cache(input_ts_file, device, make, model, track)
+    return device,make,model,track
+
+def get_metric_positions(track, fps = 1):
+    #Point positions, in frames when fps is given, where the distance from the start passes every multiple of --metric_distance.
+    #Cumulative distance covers the run of points starting at 0, see Track.update_distances
+    gaps = np.flatnonzero(~track.valid)
+    end = gaps[0] if len(gaps) else track.size
+    if end < 2:
+        return np.zeros(0)
+    metric = track.metric[:end]
+    meters = np.arange(1, int(metric[-1] // args.metric_distance) + 1) * args.metric_distance
+    #Point i is the first one at or past each distance, the frame is placed between points i-1 and i
+    i = np.searchsorted(metric, meters, side='left')
+    prevdist = track.prevdist[i]
+    moving = prevdist != 0
+    offset = np.zeros(len(i))
+    offset[moving] = fps * (meters[moving] - metric[i[moving]]) / prevdist[moving]
+    return i * fps + offset
+
+def get_frame_schedule(track, length, fps):
+    #Frame numbers to extract, in the order they are visited. fps here is frames per GPS point
+    schedule = [0]
+    if args.metric_distance > 0:
+        schedule.extend(get_metric_positions(track, fps).astype(np.int64).tolist())
+    else:
+        #Frame count reported by OpenCV is an estimate, reading stops at the first frame that does not exist
+        step = max(1, int(fps*args.sampling_interval))
+        schedule.extend(range(step, int(length * 1.1) + 1, step))
+    return schedule
+
+def get_keyframes(input_file):
+    """Frame numbers of the keyframes, found by demuxing the packets without decoding them. Empty if the backend cannot tell"""
+    keyframes = read_cache(input_file, ".keyframes.json", None)
+    if keyframes is not None:
+        return keyframes
+    keyframes = []
+    with profiler.stage("keyframe_index"):
+        video = cv2.VideoCapture(input_file)
+        if video.set(cv2.CAP_PROP_FORMAT, -1): #raw packets, grab() only demuxes
+            framecount = 0
+            while video.grab():
+                if video.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+                    keyframes.append(framecount)
+                framecount += 1
+        video.release()
+    write_cache(input_file, ".keyframes.json", None, keyframes)
+    return keyframes
 
+def get_decode_mode(schedule, video_fps):
+    if args.decode_mode != "auto":
+        return args.decode_mode
+    if len(schedule) < 2:
+        return "seek"
+    mean_gap = (schedule[-1] - schedule[0]) / (len(schedule) - 1)
+    if mean_gap <= args.stream_max_gap * video_fps:
+        return "stream"
+    return "gop"
+
+def keyframe_before(keyframes, framecount):
+    return keyframes[max(0, bisect.bisect_right(keyframes, framecount) - 1)]
+
+def snap_to_keyframes(schedule, keyframes):
+    #Moves every sample to the nearest keyframe, samples landing on the same keyframe are merged
+    snapped = []
+    for framecount in schedule:
+        i = bisect.bisect_left(keyframes, framecount)
+        nearest = min(keyframes[max(0, i - 1):i + 1], key = lambda keyframe: abs(keyframe - framecount))
+        if not snapped or nearest != snapped[-1]:
+            snapped.append(nearest)
+    return snapped
+
+class OpenCVDecoder(object):
+    '''
+    Decodes with cv2.VideoCapture
+    seek -- position the decoder before every sample, each one decodes from the previous keyframe
+    stream -- decode forward, frames in between are only grabbed and never converted
+    gop -- decode forward inside a keyframe group, seek when the next sample is in a later one, so every group is decoded at most once
+    '''
+    def __init__(self, input_file):
+        self.video = cv2.VideoCapture(input_file)
+        self.fps = self.video.get(cv2.CAP_PROP_FPS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.video.release()
+
+    def read_frames(self, schedule, decode_mode, keyframes = None):
+        """Yields (framecount, image) for every scheduled frame, stops at the first frame that cannot be read"""
+        if decode_mode == "gop" and not keyframes:
+            decode_mode = "seek"
+        position = 0 #number of the frame the decoder returns next
+        image = None
+        for framecount in schedule:
+            if decode_mode in ("stream", "gop") and framecount == position - 1 and image is not None:
+                yield framecount, image #same frame scheduled twice
+                continue
+            if args.suppress_cv2_warnings == 1:
+                with suppress_stdout_stderr(): #Just to keep the console clear from OpenCV warning messages
+                    success, image = self.read_frame(framecount, position, decode_mode, keyframes)
+            else:
+                success, image = self.read_frame(framecount, position, decode_mode, keyframes)
+            if not success:
+                break
+            position = framecount + 1
+            yield framecount, image
+
+    def read_frame(self, framecount, position, decode_mode, keyframes):
+        if decode_mode == "gop" and keyframe_before(keyframes, framecount) > position:
+            decode_mode = "seek" #the frames up to the keyframe before the target would be decoded for nothing
+        if decode_mode == "seek" or framecount < position:
+            if framecount != position:
+                with profiler.stage("seek"):
+                    self.video.set(1,framecount)
+            with profiler.stage("decode"):
+                return self.video.read()
+        with profiler.stage("decode"):
+            while position < framecount:
+                if not self.video.grab():
+                    return False, None
+                position += 1
+            if not self.video.grab():
+                return False, None
+            return self.video.retrieve()
+
+class PyAVDecoder(object):
+    '''
+    Decodes with PyAV, frame numbers are worked out from the presentation timestamps.
+    Decoding runs on --decoder_threads threads and --skip_nonref / --keyframes_only
+    make FFmpeg drop frames before decoding them; a sample falling on a dropped
+    frame gets the next decoded one. The decode modes behave as in OpenCVDecoder.
+    '''
+    def __init__(self, input_file):
+        import av #optional, only needed for --decoder pyav
+        self.container = av.open(input_file)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self.stream.codec_context.thread_count = args.decoder_threads
+        if args.keyframes_only == 1:
+            self.stream.codec_context.skip_frame = "NONKEY"
+        elif args.skip_nonref == 1:
+            self.stream.codec_context.skip_frame = "NONREF"
+        self.rate = Fraction(self.stream.average_rate or self.stream.guessed_rate)
+        self.fps = float(self.rate)
+        self.start = self.stream.start_time or 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.container.close()
+
+    def frame_index(self, frame):
+        return int(round((frame.pts - self.start) * self.stream.time_base * self.rate))
+
+    def frame_pts(self, framecount):
+        return self.start + int(framecount / (self.rate * self.stream.time_base))
+
+    def seek(self, framecount, keyframes):
+        """Returns the decoded frames from a keyframe at or before framecount. Demuxers without an index (MPEG-TS) land
+        near the timestamp instead of on a keyframe, so this steps back until decoding starts early enough"""
+        start = keyframe_before(keyframes, framecount) if keyframes else framecount
+        step = max(1, int(self.fps))
+        while start > 0:
+            self.container.seek(self.frame_pts(start), stream = self.stream)
+            frames = self.container.decode(self.stream)
+            for frame in frames:
+                if frame.key_frame:
+                    if frame.pts is None or self.frame_index(frame) <= framecount:
+                        return itertools.chain([frame], frames)
+                    break
+            start = max(0, start - step)
+            step *= 2
+        self.container.seek(self.start, stream = self.stream)
+        return self.container.decode(self.stream)
+
+    def read_frames(self, schedule, decode_mode, keyframes = None):
+        """Yields (framecount, image) for every scheduled frame, stops at the end of the video"""
+        frames = self.container.decode(self.stream)
+        frame = None
+        index = -1 #number of the last decoded frame
+        image = None
+        for framecount in schedule:
+            position = index + 1
+            if framecount < index or framecount > position and (decode_mode == "seek" or decode_mode == "gop" and (not keyframes or keyframe_before(keyframes, framecount) > position)):
+                with profiler.stage("seek"):
+                    frames = self.seek(framecount, keyframes)
+                index = -1
+            with profiler.stage("decode"):
+                while index < framecount:
+                    frame = next(frames, None)
+                    if frame is None:
+                        return
+                    index = self.frame_index(frame) if frame.pts is not None else index + 1
+                    image = None
+                if image is None:
+                    image = frame.to_ndarray(format = "bgr24")
+            yield framecount, image
+
+DECODERS = {"opencv": OpenCVDecoder, "pyav": PyAVDecoder}
+
+ROTATE_CODES = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+class FramePipeline(object):
+    '''
+    The --transforms steps, set up once per run. Steps without settings are left out.
+    The mask is brought to the size the mask step sees by running it through the
+    steps before it, once for every frame size. A crop is only a view and every
+    encoder thread reuses its own output buffers for the other steps.
+    '''
+    STEPS = ("crop", "mask", "resize", "rotate")
+
+    def __init__(self, steps, mask, width):
+        for step in steps:
+            if step not in self.STEPS:
+                raise ValueError("Unknown transform " + step + ", use " + ",".join(self.STEPS))
+        self.width = width
+        self.steps = [step for step in steps if self.is_active(step, mask, width)]
+        self.mask = mask
+        self.masks = {} #frame height and width -> mask for the mask step
+        self.local = threading.local()
+
+    @staticmethod
+    def is_active(step, mask, width):
+        if step == "crop":
+            return args.crop_top + args.crop_bottom + args.crop_left + args.crop_right > 0
+        if step == "mask":
+            return mask is not None
+        if step == "resize":
+            return width > 0
+        return args.rotate in ROTATE_CODES
+
+    def apply(self, image):
+        if not self.steps:
+            return image
+        if not hasattr(self.local, "buffers"):
+            self.local.buffers = {}
+        mask = self.get_mask(image.shape[:2]) if "mask" in self.steps else None
+        for i, step in enumerate(self.steps):
+            if step == "crop":
+                image = self.crop(image)
+            elif step == "mask":
+                #pixels outside the mask are never written, so the zeroed buffer keeps them black
+                image = cv2.bitwise_and(image, image, dst = self.buffer(i, image.shape, np.zeros), mask = mask)
+            elif step == "resize" and image.shape[1] > self.width:
+                height, width = self.resized_size(image.shape)
+                image = cv2.resize(image, (width, height), dst = self.buffer(i, (height, width) + image.shape[2:]), interpolation = cv2.INTER_AREA)
+            elif step == "rotate":
+                shape = image.shape if args.rotate == 180 else (image.shape[1], image.shape[0]) + image.shape[2:]
+                image = cv2.rotate(image, ROTATE_CODES[args.rotate], dst = self.buffer(i, shape))
+        return image
+
+    def buffer(self, i, shape, allocate = np.empty):
+        key = (i, shape)
+        if key not in self.local.buffers:
+            self.local.buffers[key] = allocate(shape, dtype = np.uint8)
+        return self.local.buffers[key]
+
+    def crop(self, image):
+        height, width = image.shape[:2]
+        return image[args.crop_top : height - args.crop_bottom,args.crop_left : width - args.crop_right]
+
+    def resized_size(self, shape):
+        return int(round(shape[0] * self.width / shape[1])), self.width
+
+    def get_mask(self, frame_size):
+        if frame_size not in self.masks:
+            if self.mask.shape != frame_size:
+                raise ValueError("Mask is %dx%d, the video %dx%d" % (self.mask.shape[1], self.mask.shape[0], frame_size[1], frame_size[0]))
+            mask = self.mask
+            for step in self.steps[:self.steps.index("mask")]:
+                if step == "crop":
+                    mask = self.crop(mask)
+                elif step == "resize" and mask.shape[1] > self.width:
+                    mask = cv2.resize(mask, self.resized_size(mask.shape)[::-1], interpolation = cv2.INTER_NEAREST)
+                elif step == "rotate":
+                    mask = cv2.rotate(mask, ROTATE_CODES[args.rotate])
+            self.masks[frame_size] = np.ascontiguousarray(mask)
+        return self.masks[frame_size]
+
+def frame_hash(image):
+    """64 bit difference hash of the cropped frame, each bit tells if a pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour"""
+    if "crop" in pipeline.steps:
+        image = pipeline.crop(image)
+    step = max(1, image.shape[0] // 72) #a sparse view is plenty for a 9x8 thumbnail and keeps this cheap on 4K frames
+    thumbnail = cv2.cvtColor(cv2.resize(image[::step, ::step], (9, 8), interpolation = cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    return int.from_bytes(np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1]).tobytes(), "big")
+
+def write_frame(image, file_name, exif_bytes):
+    with profiler.stage("transform"):
+        image = pipeline.apply(image)
+    return write_image(file_name, image, exif_bytes)
+
+class FrameWriter(object):
+    '''
+    Encoder side of the extraction pipeline. The decoding loop put()s frames with
+    their metadata into a bounded queue and a pool of threads masks, crops, encodes
+    and writes them. OpenCV releases the GIL for this work, so the threads run in
+    parallel with decoding. With 0 threads frames are written inline.
+    '''
+    def __init__(self, threads, queue_depth):
+        self.queue = queue.Queue(maxsize = max(1, queue_depth))
+        self.errors = []
+        self.lock = threading.Lock()
+        self.written = 0
+        self.bytes = 0
+        self.encode_time = 0.0
+        self.threads = [threading.Thread(target = self.run, daemon = True) for x in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors and exc_type is None:
+            raise self.errors[0]
+
+    def put(self, image, file_name, exif_bytes):
+        if self.errors:
+            raise self.errors[0]
+        if self.threads:
+            self.queue.put((image, file_name, exif_bytes))
+        else:
+            self.record(*write_frame(image, file_name, exif_bytes))
+
+    def record(self, size, encode_time):
+        with self.lock:
+            self.written += 1
+            self.bytes += size
+            self.encode_time += encode_time
+
+    def run(self):
         while True:
-            currentdata = {}
-            input_packet = f.read(188)
-            if not input_packet:
+            item = self.queue.get()
+            if item is None:
                 break
-         
-            if device == 'B' and prevpacket and input_packet.startswith(bytes("\x47\x03\x00", encoding="raw_unicode_escape")):
-                bs = list(input_packet)
-                hour = int.from_bytes(prevpacket[174:178], byteorder='little')
-                minute = int.from_bytes(prevpacket[178:182], byteorder='little')
-                second = int.from_bytes(prevpacket[182:186], byteorder='little')
-                year = int.from_bytes(prevpacket[186:188] + input_packet[146:148], byteorder='little')
-                month = int.from_bytes(input_packet[148:152], byteorder='little')
-                day = int.from_bytes(input_packet[152:156], byteorder='little')
-                active = chr(bs[156])
-                lathem = chr(bs[157])
-                lonhem = chr(bs[158])
-                lat = fix_coordinates(lathem,struct.unpack('<f', input_packet[160:164]))
-                lon = fix_coordinates(lonhem,struct.unpack('<f', input_packet[164:168]))
-                speed_knots, = struct.unpack('<f', input_packet[168:172])
-                speed = speed_knots * 1.6 / 3.6
-                bearing, = struct.unpack('<f', input_packet[172:176])
-                currentdata["ts"] = datetime(year=2000+year, month=month, day=day, hour=hour, minute=minute, second=second).replace(tzinfo=timezone.utc).timestamp()
-                currentdata["lat"] = lat
-                currentdata["latR"] = lathem
-                currentdata["lon"] = lon
-                currentdata["lonR"] = lonhem
-                currentdata["bearing"] = bearing
-                currentdata["speed"] = speed
-                currentdata["mx"],currentdata["my"] = lonlat_metric(lon,lat)
-                currentdata["metric"] = 0
-                currentdata["prevdist"] = 0
-                if active == "A":
-                    locdata[packetno] = currentdata
-                packetno += 1
-                #print ('20{0:02}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(year,month,day,hour,minute,second),active,lathem,lonhem,lat,lon,speed,bearing, sep=';')
-            if device == 'V' and input_packet.startswith(bytes("\x47\x43\x00", encoding="raw_unicode_escape")):
-                bs = list(input_packet)
-                hour = int.from_bytes(input_packet[10:14], byteorder='little')
-                minute = int.from_bytes(input_packet[14:18], byteorder='little')
-                second = int.from_bytes(input_packet[18:22], byteorder='little')
-                year = int.from_bytes(input_packet[22:26], byteorder='little')
-                month = int.from_bytes(input_packet[26:30], byteorder='little')
-                day = int.from_bytes(input_packet[30:34], byteorder='little')
-                active = chr(bs[34])
-                lathem = chr(bs[35])
-                lonhem = chr(bs[36])
-                lat = fix_coordinates(lathem,struct.unpack('<f', input_packet[38:42]))
-                lon = fix_coordinates(lonhem,struct.unpack('<f', input_packet[42:46]))
-                speed_knots, = struct.unpack('<f', input_packet[46:50])
-                speed = speed_knots * 1.6 / 3.6
-                bearing, = struct.unpack('<f', input_packet[50:54])
-                currentdata["ts"] = datetime(year=2000+year, month=month, day=day, hour=hour, minute=minute, second=second).replace(tzinfo=timezone.utc).timestamp()
-                currentdata["lat"] = lat
-                currentdata["latR"] = lathem
-                currentdata["lon"] = lon
-                currentdata["lonR"] = lonhem
-                currentdata["bearing"] = bearing
-                currentdata["speed"] = speed
-                currentdata["mx"],currentdata["my"] = lonlat_metric(lon,lat)
-                currentdata["metric"] = 0
-                currentdata["prevdist"] = 0
-                if active == "A":
-                    locdata[packetno] = currentdata
-                packetno += 1
-                #print ('20{0:02}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(year,month,day,hour,minute,second),active,lathem,lonhem,lat,lon,speed,bearing, sep=';')
-            prevpacket = input_packet
-            del currentdata
-    return locdata, packetno 
+            if self.errors:
+                continue #keep draining so the decoding side never blocks
+            try:
+                self.record(*write_frame(*item))
+            except Exception as e:
+                self.errors.append(e)
 
-try:
-    os.mkdir(folder)
-except:
-    pass
-
-if os.path.isfile(input_ts_file):
-    inputfiles = [input_ts_file]
-if os.path.isdir(input_ts_file):
-    inputfiles = glob.glob(input_ts_file + os.path.sep + '*.ts')
-    inputfiles.extend(glob.glob(input_ts_file + os.path.sep + '*.mp4'))
-   
-   
-for input_ts_file in inputfiles:
-    
+def build_plan(input_ts_file):
+    """Works out which frames to extract and the metadata of every image, no pixels are decoded"""
     print (input_ts_file)
-    device,make,model = detect_file_type(input_ts_file)
+    device,make,model,track = get_gps_data(input_ts_file)
     print (make,model,device)
 
-    video = cv2.VideoCapture(input_ts_file)
-    fps = video.get(cv2.CAP_PROP_FPS)
-    length = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps, length = get_video_info(input_ts_file)
     print ("FPS : {0}; LEN: {1}".format(fps,length))
     
-    interval = int(args.sampling_interval*fps)
-    if interval == 0:
-        interval = 1
-    locdata = {}
-    packetno = 0
-    if device in "BV":
-        locdata,packetno = get_gps_data_ts(input_ts_file, device)
-    if device in "T":
-        locdata,packetno = get_gps_data_nt(input_ts_file, device)
-    if device in "N":
-        locdata,packetno = get_gps_data_nmea(input_ts_file, device)
-    if device in "G":
-        locdata,packetno = get_gps_data_garmin(input_ts_file, device)
-    if device in "NB":
-        locdata,packetno = get_gps_data_nextbase(input_ts_file, device)
-
-    print ("GPS data analysis ended, no of points ", len(locdata))
+    packetno = track.size
+
+    print ("GPS data analysis ended, no of points ", len(track))
     if packetno > 0:
         print ("Frames per point: ", length/packetno)
         fps = length/packetno
@@ -683,197 +1463,590 @@ for input_ts_file in inputfiles:
     if args.csv == 1:
         with open(input_ts_file.split(os.path.sep)[-1].replace(".ts","_")+"pre_interp.csv", "w") as xf:
             print ("i;lat;lon;ts;speed;bearing", file=xf)
-            for i in locdata:
-                print (i,locdata[i]["lat"],locdata[i]["lon"],locdata[i]["speed"],locdata[i]["bearing"], sep=";", file=xf)
+            for i in track.indices():
+                print (i,track.lat[i],track.lon[i],track.speed[i],track.bearing[i], sep=";", file=xf)
     
     ###
     
-    if len(locdata)<args.min_coverage*length*0.01/fps:
-        print ("Not enough GPS data for interpolation",args.min_coverage,"% needed, ",len(locdata)*100/length*fps,"% found")
-    else:
-        if len(locdata)<length/fps:
-            print ("Interpolating missing points")
-            i = 0
-            while i < length/fps:
-                if i not in locdata:
-                    #Find previous existing
-                    prev_data = i - 1
-                    next_data = i + 1
-                    while prev_data not in locdata and prev_data>0:
-                        prev_data -= 1
-                 
-                    #Find next existing
-                    while next_data not in locdata and next_data<length/fps:
-                        next_data += 1
-                    if prev_data in locdata and next_data in locdata:
-                        currentdata = {}
-
-                        current_position = float(i-prev_data)/float(next_data-prev_data)
-                        currentdata["ts"] = locdata[prev_data]["ts"]+(locdata[(next_data)]["ts"]-locdata[prev_data]["ts"])*current_position
-                        currentdata["lat"] = locdata[prev_data]["lat"]+(locdata[(next_data)]["lat"]-locdata[prev_data]["lat"])*current_position
-                        currentdata["lon"] = locdata[prev_data]["lon"]+(locdata[(next_data)]["lon"]-locdata[prev_data]["lon"])*current_position
-                        currentdata["mx"] = locdata[prev_data]["mx"]+(locdata[(next_data)]["mx"]-locdata[prev_data]["mx"])*current_position
-                        currentdata["my"] = locdata[prev_data]["my"]+(locdata[(next_data)]["my"]-locdata[prev_data]["my"])*current_position
-                        currentdata["bearing"] = locdata[prev_data]["bearing"]+(locdata[(next_data)]["bearing"]-locdata[prev_data]["bearing"])*current_position
-                        currentdata["speed"] = locdata[prev_data]["speed"]+(locdata[(next_data)]["speed"]-locdata[prev_data]["speed"])*current_position
-                        currentdata["metric"] = 0
-                        currentdata["prevdist"] = 0
-                        locdata[i] = currentdata
-                        del currentdata
-                i=i+1
-        i=0
-        while not i in locdata:
-            i+=1  #extrapolate down
-        
-        while i > 3:
-            if not i in locdata:
-                currentdata = {}
-                
-                currentdata["ts"] = locdata[i+1]["ts"]-(locdata[(i+2)]["ts"]-locdata[i+1]["ts"])
-                currentdata["lat"] = locdata[i+1]["lat"]-(locdata[(i+2)]["lat"]-locdata[i+1]["lat"])
-                currentdata["lon"] = locdata[i+1]["lon"]-(locdata[(i+2)]["lon"]-locdata[i+1]["lon"])
-                currentdata["mx"] = locdata[i+1]["mx"]-(locdata[(i+2)]["mx"]-locdata[i+1]["mx"])
-                currentdata["my"] = locdata[i+1]["my"]-(locdata[(i+2)]["my"]-locdata[i+1]["my"])
-                currentdata["bearing"] = locdata[i+1]["bearing"]-(locdata[(i+2)]["bearing"]-locdata[i+1]["bearing"])
-                currentdata["speed"] = locdata[i+1]["speed"]-(locdata[(i+2)]["speed"]-locdata[i+1]["speed"])
-                currentdata["metric"] = 0
-                currentdata["prevdist"] = 0
-                locdata[i] = currentdata
-                del currentdata
-            i-=1
-        i=0
-        
-        while i in locdata:
-            i+=1
-        while i < length / fps * 1.1 and len(locdata)>1:
-            if not i in locdata:
-                currentdata = {}
-                
-                currentdata["ts"] = locdata[i-1]["ts"]-(locdata[(i-2)]["ts"]-locdata[i-1]["ts"])
-                currentdata["lat"] = locdata[i-1]["lat"]-(locdata[(i-2)]["lat"]-locdata[i-1]["lat"])
-                currentdata["lon"] = locdata[i-1]["lon"]-(locdata[(i-2)]["lon"]-locdata[i-1]["lon"])
-                currentdata["mx"] = locdata[i-1]["mx"]-(locdata[(i-2)]["mx"]-locdata[i-1]["mx"])
-                currentdata["my"] = locdata[i-1]["my"]-(locdata[(i-2)]["my"]-locdata[i-1]["my"])
-                currentdata["bearing"] = locdata[i-1]["bearing"]-(locdata[(i-2)]["bearing"]-locdata[i-1]["bearing"])
-                currentdata["speed"] = locdata[i-1]["speed"]-(locdata[(i-2)]["speed"]-locdata[i-1]["speed"])
-                currentdata["metric"] = 0
-                currentdata["prevdist"] = 0
-                locdata[i] = currentdata
-                del currentdata
-            i+=1
-    i=1
-    while i in locdata:
-        locdata[i]["prevdist"] = math.cos(math.radians(locdata[i]["lat"])) * math.sqrt(pow(locdata[i-1]["mx"]-locdata[i]["mx"],2)+pow(locdata[i-1]["my"]-locdata[i]["my"],2))
-        locdata[i]["metric"] = locdata[i-1]["metric"] + locdata[i]["prevdist"]
-        i += 1
+    with profiler.stage("interpolate"):
+        if len(track)<args.min_coverage*length*0.01/fps:
+            print ("Not enough GPS data for interpolation",args.min_coverage,"% needed, ",len(track)*100/length*fps,"% found")
+        else:
+            end = int(math.ceil(length / fps * 1.1))
+            track.resize(max(track.size, end))
+            filled = track.interpolate_gaps()
+            if filled > 0:
+                print ("Interpolated", filled, "missing points")
+            track.extrapolate_edges(4, end) #the first seconds are left without GPS
+        track.update_distances()
 
     ###Logging
     if args.csv == 1:
         with open(input_ts_file.split(os.path.sep)[-1].replace(".ts","_")+"post_interp.csv", "w") as xf:
             print ("no;lat;lon;ts;speed;bearing", file=xf)
-            for i in locdata:
-                print (i,locdata[i]["lat"],locdata[i]["lon"],locdata[i]["speed"],locdata[i]["bearing"], sep=";", file=xf)
+            for i in track.indices():
+                print (i,track.lat[i],track.lon[i],track.speed[i],track.bearing[i], sep=";", file=xf)
     
     ###     
 
-    if len(locdata)<args.min_points:
+    rows = []
+    if len(track)<args.min_points:
         print ("Not enough GPS data for frame extraction.")
     else:
-        print ("Video extraction started")
-        framecount = 0
-        errormessage = 0
-        count = 0
-        meters = 0
-        if args.make:
-            make = args.make
-        if args.model:
-            model = args.model
-        success,image = video.read()
-        while success:
-
-            if True:
-                #interpolate time and coordinates
-                prev_dataframe = (float(math.trunc(float(framecount+timeshift*fps)/fps)))
-                while prev_dataframe+1 not in locdata and prev_dataframe >= length/fps - 2:
-                    prev_dataframe -= 1
-                if prev_dataframe in locdata and prev_dataframe + 1 in locdata:
-                    current_position = (framecount + timeshift*fps - prev_dataframe*fps)/fps 
-                    new_speed = locdata[prev_dataframe]["speed"]+(locdata[(prev_dataframe+1)]["speed"]-locdata[prev_dataframe]["speed"])*current_position
-                    if new_speed >= args.min_speed or args.metric_distance > 0:
-                        meter = locdata[prev_dataframe]["metric"]+(locdata[(prev_dataframe+1)]["metric"]-locdata[prev_dataframe]["metric"])*current_position
-                        new_ts = locdata[prev_dataframe]["ts"]+(locdata[(prev_dataframe+1)]["ts"]-locdata[prev_dataframe]["ts"])*current_position
-                        new_lat = locdata[prev_dataframe]["lat"]+(locdata[(prev_dataframe+1)]["lat"]-locdata[prev_dataframe]["lat"])*current_position
-                        new_lon = locdata[prev_dataframe]["lon"]+(locdata[(prev_dataframe+1)]["lon"]-locdata[prev_dataframe]["lon"])*current_position
-                        if args.bearing_recalculate == 1:
-                            new_bear = args.bearing_modifier + calculate_initial_compass_bearing((locdata[prev_dataframe]["lat"],locdata[prev_dataframe]["lon"]),(locdata[(prev_dataframe+1)]["lat"],locdata[(prev_dataframe+1)]["lon"]))
-                        else:
-                            new_bear = args.bearing_modifier + locdata[prev_dataframe]["bearing"]+(locdata[(prev_dataframe+1)]["bearing"]-locdata[prev_dataframe]["bearing"])*current_position
-                        while new_bear < 0:
-                            new_bear += 360
-                        while new_bear > 360:
-                            new_bear -= 360
-                        lonref, lon2 = to_gps_latlon(new_lon, ('E', 'W'))
-                        latref, lat2 = to_gps_latlon(new_lat, ('N', 'S'))
-                        #print (latref,lat2,new_lat)
-                        if args.mask:
-                            image = cv2.bitwise_and(image,image,mask = mask)
-                        if args.crop_top + args.crop_bottom + args.crop_left + args.crop_right > 0:
-                            height, width, channels = image.shape
-                            image = image[args.crop_top : height - args.crop_bottom,args.crop_left : width - args.crop_right]
-                        cv2.imwrite("tmp.jpg", image)
-                        
-                        
-                        
-    
-                        e_image = Image("tmp.jpg")
-                        #e_image.gps_latitude = lat2
-                        #e_image.gps_latitude_ref = latref
-                        #e_image.gps_longitude  = lon2
-                        #e_image.gps_longitude_ref = lonref
-                        #e_image.gps_img_direction = new_bear
-                        #e_image.gps_dest_bearing = new_bear
-                        #e_image.make = make
-                        #e_image.model = model
-                        datetime_taken = datetime.fromtimestamp(new_ts+args.timezone*3600)
-                        datetime_original = datetime_taken.strftime(DATETIME_STR_FORMAT)
-                        
-                        with open(folder+os.path.sep+input_ts_file.split(os.path.sep)[-1].replace(".ts","_") + "_"+"%06d" % count + ".jpg", 'wb') as new_image_file:
-                            new_image_file.write(e_image.get_file())
-                        set_gps_location(folder+os.path.sep+input_ts_file.split(os.path.sep)[-1].replace(".ts","_") + "_"+"%06d" % count + ".jpg", new_lat, new_lon, new_bear, make, model, datetime_original)
-                        #print('Frame: ', framecount)
-                        count += 1
+        plan_start = time.perf_counter()
+        schedule = snap_schedule(input_ts_file, get_frame_schedule(track, length, fps))
+        rows = plan_rows(input_ts_file, track, schedule, fps, length, make, model)
+        profiler.add("plan", time.perf_counter() - plan_start)
+    return {"file": input_ts_file, "rows": rows}
+
+def get_video_info(input_ts_file):
+    #Frame rate and frame count as reported by OpenCV, the count is an estimate
+    with profiler.stage("open"):
+        video = cv2.VideoCapture(input_ts_file)
+        fps = video.get(cv2.CAP_PROP_FPS)
+        length = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        video.release()
+    return fps, length
+
+def snap_schedule(input_ts_file, schedule):
+    if args.keyframes_only == 1:
+        keyframes = get_keyframes(input_ts_file)
+        if keyframes:
+            return snap_to_keyframes(schedule, keyframes)
+        print ("No keyframe information, --keyframes_only ignored")
+    return schedule
+
+def plan_rows(input_ts_file, track, schedule, fps, length, make, model, first_number = 0):
+    """Time, position and output name of every scheduled frame, frames without GPS on both sides are left out
+    fps -- frames per GPS point
+    first_number -- number of the first image, trips go on counting from the file before
+    """
+    rows = []
+    errormessage = 0
+    if args.plan_only == 1:
+        #Extraction reads on past the estimated frame count until the video ends, a plan only lists frames known to exist
+        schedule = [framecount for framecount in schedule if framecount < length]
+    if args.make:
+        make = args.make
+    if args.model:
+        model = args.model
+    name = input_ts_file.split(os.path.sep)[-1].replace(".ts","_")
+    for framecount in schedule:
+        #interpolate time and coordinates
+        prev_dataframe = math.trunc(float(framecount+timeshift*fps)/fps)
+        while prev_dataframe+1 not in track and prev_dataframe >= length/fps - 2:
+            prev_dataframe -= 1
+        if prev_dataframe in track and prev_dataframe + 1 in track:
+            a = prev_dataframe
+            b = prev_dataframe + 1
+            current_position = (framecount + timeshift*fps - prev_dataframe*fps)/fps 
+            new_speed = float(track.speed[a]+(track.speed[b]-track.speed[a])*current_position)
+            if new_speed >= args.min_speed or args.metric_distance > 0:
+                new_ts = float(track.ts[a]+(track.ts[b]-track.ts[a])*current_position)
+                new_lat = float(track.lat[a]+(track.lat[b]-track.lat[a])*current_position)
+                new_lon = float(track.lon[a]+(track.lon[b]-track.lon[a])*current_position)
+                if args.bearing_recalculate == 1:
+                    new_bear = args.bearing_modifier + calculate_initial_compass_bearing((float(track.lat[a]),float(track.lon[a])),(float(track.lat[b]),float(track.lon[b])))
                 else:
-                    if errormessage == 0:
-                        print ("No valid GPS for frame %d, this frame and others will be skipped." % framecount)
-                        errormessage = 1
-
-            if args.metric_distance > 0:
-                meters = meters + args.metric_distance
-                i = 1
-                while i in locdata and not (meters >= locdata[i-1]["metric"] and meters<=locdata[i]["metric"]):
-                    i+=1
-                if i in locdata and meters >= locdata[i-1]["metric"] and meters<=locdata[i]["metric"]:
+                    new_bear = float(args.bearing_modifier + track.bearing[a]+(track.bearing[b]-track.bearing[a])*current_position)
+                while new_bear < 0:
+                    new_bear += 360
+                while new_bear > 360:
+                    new_bear -= 360
+                rows.append({"input": input_ts_file, "frame_index": framecount, "ts": new_ts, "lat": new_lat, "lon": new_lon, "bearing": new_bear, "speed": new_speed,
+                             "output_name": name + "_"+"%06d" % (first_number + len(rows)) + profile["extension"], "make": make, "model": model})
+        else:
+            if errormessage == 0:
+                print ("No valid GPS for frame %d, this frame and others will be skipped." % framecount)
+                errormessage = 1
+    return rows
+
+def read_trip_file(input_ts_file):
+    #GPS track and video length of one file of a trip
+    print (input_ts_file)
+    device,make,model,track = get_gps_data(input_ts_file)
+    fps, length = get_video_info(input_ts_file)
+    return {"file": input_ts_file, "make": make, "model": model, "track": track, "fps": fps, "length": length}
+
+def get_trip_timing(entry):
+    """Start time, seconds per GPS point and number of points of a trip file. The start comes from the GPS
+    time stamps, files without them are placed by their modification time, taken as the end of the recording"""
+    track = entry["track"]
+    known = track.indices()
+    known = known[track.ts[known] > 0]
+    duration = entry["length"] / entry["fps"] if entry["fps"] > 0 else 0
+    points = track.size or max(1, int(round(duration)))
+    if len(known) >= 2 and track.ts[known[-1]] > track.ts[known[0]]:
+        seconds = float(track.ts[known[-1]] - track.ts[known[0]]) / (known[-1] - known[0])
+    else:
+        seconds = duration / points if duration > 0 else 1.0
+    if len(known):
+        start = float(track.ts[known[0]]) - known[0] * seconds
+    else:
+        start = os.path.getmtime(entry["file"]) - points * seconds
+    return start, seconds, points
+
+def split_trips(entries):
+    #Orders the files by start time, more than --trip_gap seconds between the end of a file and the start of the next one starts a new trip
+    for entry in entries:
+        entry["start"], entry["seconds"], entry["points"] = get_trip_timing(entry)
+    trips = []
+    end = None
+    for entry in sorted(entries, key = lambda entry: entry["start"]):
+        if end is None or abs(entry["start"] - end) > args.trip_gap:
+            trips.append([])
+        trips[-1].append(entry)
+        end = entry["start"] + entry["points"] * entry["seconds"]
+    return trips
+
+def build_trip_plans(trip):
+    """Joins the tracks of the files of a trip into one, the time between two files becomes empty points.
+    Gaps are interpolated and distances measured over the whole trip, then the frame positions are
+    cut back into a plan per file, numbered on from the file before"""
+    offset = 0
+    end = None
+    for entry in trip:
+        if end is not None:
+            offset += max(0, int(round((entry["start"] - end) / entry["seconds"])))
+        entry["offset"] = offset
+        offset += entry["points"]
+        end = entry["start"] + entry["points"] * entry["seconds"]
+    length = offset + int(math.ceil(trip[-1]["points"] * 0.1)) #frame counts are estimates, the last file may run longer
+    track = Track(length)
+    for entry in trip:
+        track.place(entry["track"], entry["offset"])
+    print ("Trip of", len(trip), "files, GPS points", len(track), "of", offset)
+
+    with profiler.stage("interpolate"):
+        if len(track)<args.min_coverage*offset*0.01:
+            print ("Not enough GPS data for interpolation",args.min_coverage,"% needed, ",len(track)*100/offset,"% found")
+        else:
+            filled = track.interpolate_gaps()
+            if filled > 0:
+                print ("Interpolated", filled, "missing points")
+            track.extrapolate_edges(4, length) #the first seconds are left without GPS
+        track.update_distances()
+
+    plans = []
+    number = 0
+    if len(track)<args.min_points:
+        print ("Not enough GPS data for frame extraction.")
+        return [{"file": entry["file"], "rows": []} for entry in trip]
+    plan_start = time.perf_counter()
+    if args.metric_distance > 0:
+        positions = np.concatenate(([0], get_metric_positions(track)))
+    else:
+        positions = np.arange(0, length, args.sampling_interval)
+    for entry in trip:
+        fps = entry["length"] / entry["points"]
+        stop = length if entry is trip[-1] else entry["offset"] + entry["points"]
+        inside = positions[(positions >= entry["offset"]) & (positions < stop)]
+        schedule = snap_schedule(entry["file"], ((inside - entry["offset"]) * fps).astype(np.int64).tolist())
+        #one point past the end, frames in the last second of a file lie between it and the first point of the next
+        section = track.section(entry["offset"], stop + 1 + max(0, int(math.ceil(timeshift))))
+        rows = plan_rows(entry["file"], section, schedule, fps, entry["length"], entry["make"], entry["model"], number)
+        number += len(rows)
+        plans.append({"file": entry["file"], "rows": rows})
+    profiler.add("plan", time.perf_counter() - plan_start)
+    return plans
+
+def run_trips(inputfiles):
+    #Files are read and frames extracted in parallel, only joining the tracks is done in one go
+    global profiler
+    entries = run_jobs(read_trip_file, inputfiles, inputfiles)
+    failed = [entry for entry in entries if "error" in entry]
+    read = {entry["file"]: entry for entry in entries if "error" not in entry}
+    plans = []
+    for number, trip in enumerate(split_trips(list(read.values()))):
+        print ("Trip", number + 1, ":", ", ".join(entry["file"] for entry in trip))
+        profiler = Profiler(args.profile == 1)
+        with profiler.stage("total"):
+            plans.extend(build_trip_plans(trip))
+        if profiler.enabled:
+            trip_profiles["trip %d" % (number + 1)] = profiler.stages
+    if args.plan_only == 1:
+        for plan in plans:
+            write_plan(plan)
+        results = [{"file": plan["file"], "images": len(plan["rows"])} for plan in plans]
+    else:
+        results = run_jobs(execute_plan, plans, [plan["file"] for plan in plans])
+    for result in results:
+        add_profile(result, read[result["file"]]) #reading a file is part of its figures, joining the tracks is reported per trip
+    return failed + results
+
+def get_plan_file(input_ts_file):
+    return folder+os.path.sep+os.path.splitext(input_ts_file.split(os.path.sep)[-1])[0]+"_plan.csv"
+
+def write_plan(plan):
+    with open(get_plan_file(plan["file"]), "w", newline="") as pf:
+        writer = csv.DictWriter(pf, PLAN_COLUMNS, delimiter=";")
+        writer.writeheader()
+        writer.writerows(plan["rows"])
+
+def read_plans(plan_path):
+    """Loads plan files written by --plan_only, a folder loads every *_plan.csv in it. Returns one plan per input video"""
+    plan_files = [plan_path]
+    if os.path.isdir(plan_path):
+        plan_files = sorted(glob.glob(plan_path + os.path.sep + '*_plan.csv'))
+    plans = {}
+    for plan_file in plan_files:
+        with open(plan_file, newline="") as pf:
+            for row in csv.DictReader(pf, delimiter=";"):
+                row["frame_index"] = int(row["frame_index"])
+                for column in ("ts", "lat", "lon", "bearing", "speed"):
+                    row[column] = float(row[column])
+                plans.setdefault(row["input"], {"file": row["input"], "rows": []})["rows"].append(row)
+    for plan in plans.values():
+        plan["rows"].sort(key=lambda row: row["frame_index"]) #frames are decoded in order
+    return list(plans.values())
+
+def get_duplicates_file(input_ts_file):
+    return folder+os.path.sep+os.path.splitext(input_ts_file.split(os.path.sep)[-1])[0]+"_duplicates.txt"
+
+def read_duplicates(input_ts_file):
+    #Output names of the frames an earlier run skipped as near-duplicates, they have no output file but are finished
+    try:
+        with open(get_duplicates_file(input_ts_file), "r") as f:
+            return set(line.strip() for line in f)
+    except OSError:
+        return set()
+
+def get_output_file(row):
+    #The output profile decides the format, also for plans written with another one
+    return folder+os.path.sep+os.path.splitext(row["output_name"])[0]+profile["extension"]
+
+def execute_plan(plan, resume = False, record = False):
+    """Extracts the planned frames, resume keeps the outputs already written by an interrupted run.
+    record keeps the names of frames skipped as near-duplicates, a later resume needs them"""
+    input_ts_file = plan["file"]
+    rows = plan["rows"]
+    count = 0
+    duplicates = 0
+    stats = {"written": 0, "bytes": 0, "encode_time": 0.0}
+    dedup = args.dedup_threshold >= 0
+    skipped = set()
+    if resume:
+        if dedup:
+            skipped = read_duplicates(input_ts_file)
+        rows = [row for row in rows if row["output_name"] not in skipped and not os.path.exists(get_output_file(row))]
+        duplicates = sum(1 for row in plan["rows"] if row["output_name"] in skipped)
+        count = len(plan["rows"]) - len(rows) - duplicates
+        print ("Resuming,", count, "images already extracted")
+    #(row, write) pairs, a frame is compared with the last one written before it, so on resume
+    #that frame is decoded again for its hash wherever the interrupted run left off
+    work = [(row, True) for row in rows]
+    if resume and dedup and rows:
+        pending = set(id(row) for row in rows)
+        work = []
+        last_written = None
+        for row in plan["rows"]:
+            if id(row) in pending:
+                if last_written is not None:
+                    work.append((last_written, False))
+                    last_written = None
+                work.append((row, True))
+            elif row["output_name"] not in skipped:
+                last_written = row
+    if rows:
+        schedule = [row["frame_index"] for row, write in work]
+        with DECODERS[args.decoder](input_ts_file) as decoder, \
+             (open(get_duplicates_file(input_ts_file), "a" if resume else "w") if dedup and record else contextlib.nullcontext()) as duplicates_log:
+            decode_mode = get_decode_mode(schedule, decoder.fps)
+            keyframes = None
+            if decode_mode == "gop":
+                keyframes = get_keyframes(input_ts_file)
+                print ("Keyframes: ", len(keyframes))
+            print ("Video extraction started, decoder:", args.decoder, "decode mode:", decode_mode)
+            last_hash = None
+            with FrameWriter(args.encoder_threads, args.queue_depth) as writer:
+                for (row, write), (framecount, image) in zip(work, decoder.read_frames(schedule, decode_mode, keyframes)):
+                    if dedup:
+                        with profiler.stage("dedup"):
+                            current_hash = frame_hash(image)
+                        if not write:
+                            last_hash = current_hash
+                            continue
+                        if last_hash is not None and bin(current_hash ^ last_hash).count("1") <= args.dedup_threshold:
+                            duplicates += 1
+                            if duplicates_log:
+                                duplicates_log.write(row["output_name"] + "\n")
+                                duplicates_log.flush() #resume has to know about it after a crash
+                            continue
+                        last_hash = current_hash
+                    datetime_taken = datetime.fromtimestamp(row["ts"]+args.timezone*3600)
+                    datetime_original = datetime_taken.strftime(DATETIME_STR_FORMAT)
+                    exif_bytes = get_exif_bytes(row["lat"], row["lon"], row["bearing"], row["make"], row["model"], datetime_original)
+                    with profiler.stage("queue_wait"):
+                        writer.put(image, get_output_file(row), exif_bytes)
+                    #print('Frame: ', framecount)
+                    count += 1
+            stats = {"written": writer.written, "bytes": writer.bytes, "encode_time": writer.encode_time}
+        print (input_ts_file, " processed, ", count, " images extracted")
+        if dedup:
+            print (duplicates, " near-duplicate frames skipped")
+        print_profile_stats(stats)
+    return dict(stats, file = input_ts_file, images = count, duplicates = duplicates)
+
+def print_profile_stats(stats):
+    if stats["written"] > 0:
+        print ("Output profile {0}: {1:.0f} bytes/frame, {2:.1f} ms encoding/frame".format(args.output_profile, stats["bytes"]/stats["written"], stats["encode_time"]*1000/stats["written"]))
+
+def process_file(input_ts_file):
+    if args.plan_only == 1:
+        plan = build_plan(input_ts_file)
+        write_plan(plan)
+        print (input_ts_file, " planned, ", len(plan["rows"]), " images")
+        return {"file": input_ts_file, "images": len(plan["rows"])}
+    entry = {"file": os.path.abspath(input_ts_file), "size": os.path.getsize(input_ts_file), "mtime": os.stat(input_ts_file).st_mtime_ns,
+             "hash": quick_hash(input_ts_file) if args.manifest else None, "params": {name: getattr(args, name) for name in OUTPUT_PARAMS},
+             "version": GPS_CACHE_VERSION} #a newer detector or parser may find GPS data where an older one found none
+    previous = manifest.get(entry["file"])
+    resume = False
+    if previous and all(previous.get(key) == entry[key] for key in ("size", "hash", "params", "version")):
+        if previous["done"]:
+            print (input_ts_file, " unchanged since the last run, skipped")
+            return {"file": input_ts_file, "images": previous["images"], "skipped": True}
+        resume = True
+    append_manifest(dict(entry, images = 0, done = False))
+    result = execute_plan(build_plan(input_ts_file), resume, args.manifest == 1)
+    append_manifest(dict(entry, images = result["images"], done = True))
+    return result
+
+def run_profiled(function, item):
+    #Runs one input with fresh stage figures and adds them to its result
+    global profiler
+    profiler = Profiler(args.profile == 1)
+    with profiler.stage("total"):
+        result = function(item)
+    if profiler.enabled:
+        result["profile"] = profiler.stages
+        result["profile_rss_scope"] = profiler.rss_scope
+    return result
+
+def add_stages(stages, other):
+    #Adds up the stage figures of other into stages, peak RSS is the higher one
+    for name, stage in other.items():
+        entry = stages.setdefault(name, {"seconds": 0.0, "calls": 0, "peak_rss_mb": 0.0})
+        entry["seconds"] += stage["seconds"]
+        entry["calls"] += stage["calls"]
+        entry["peak_rss_mb"] = max(entry["peak_rss_mb"], stage["peak_rss_mb"])
+    return stages
+
+def add_profile(result, other):
+    #Adds the figures of an earlier run on the same input to a result, like reading a trip file before its frames are extracted
+    if "profile" not in other:
+        return
+    add_stages(result.setdefault("profile", {}), other["profile"])
+    result["profile_rss_scope"] = "input" if result.get("profile_rss_scope", "input") == other["profile_rss_scope"] == "input" else "process"
+
+def run_jobs(function, items, names):
+    summary = []
+    if args.jobs > 1 and len(items) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=setup, initargs=(args,)) as executor:
+            futures = [executor.submit(run_profiled, function, item) for item in items]
+            for name, future in zip(names, futures):
+                try:
+                    summary.append(future.result())
+                except Exception as e:
+                    print (name, " failed: ", e)
+                    summary.append({"file": name, "images": 0, "error": str(e)})
+    else:
+        for item in items:
+            summary.append(run_profiled(function, item))
+    return summary
+
+def write_profile(summary):
+    #profile.json keeps the figures of every input, the table adds them up. Encoder thread stages count the time of all threads.
+    #Peak RSS is per input where it can be reset, else the peak of the process that ran the input, earlier inputs included
+    files = {result["file"]: result["profile"] for result in summary if "profile" in result}
+    scope = "input" if all(result.get("profile_rss_scope") == "input" for result in summary if "profile" in result) else "process"
+    total = {}
+    for stages in list(files.values()) + list(trip_profiles.values()):
+        add_stages(total, stages)
+    report = {"files": files, "total": total, "peak_rss_scope": scope}
+    if trip_profiles:
+        report["trips"] = trip_profiles #--trip joins the tracks of all files of a trip at once, these stages belong to no single file
+    with open(os.path.join(folder, "profile.json"), "w") as f:
+        json.dump(report, f, indent = 1)
+    print ("stage;calls;seconds;peak RSS MB " + ("per input" if scope == "input" else "of the process"))
+    for name, stage in sorted(total.items(), key = lambda item: -item[1]["seconds"]):
+        print (name, stage["calls"], "%.3f" % stage["seconds"], "%.0f" % stage["peak_rss_mb"], sep=";")
+    print ("Profile written to", os.path.join(folder, "profile.json"))
+
+def print_summary(summary):
+    print ("Summary:")
+    for result in summary:
+        if "error" in result:
+            print (result["file"], "failed:", result["error"], sep=";")
+        elif result.get("skipped"):
+            print (result["file"], result["images"], "skipped", sep=";")
+        elif args.dedup_threshold >= 0 and "duplicates" in result:
+            print (result["file"], result["images"], "%d duplicates skipped" % result["duplicates"], sep=";")
+        else:
+            print (result["file"], result["images"], sep=";")
+    if args.plan_only == 1:
+        print ("Total images planned:", sum(result["images"] for result in summary))
+    else:
+        print ("Total images extracted:", sum(result["images"] for result in summary if not result.get("skipped")))
+        print_profile_stats({name: sum(result.get(name, 0) for result in summary) for name in ("written", "bytes", "encode_time")})
+        skipped = sum(1 for result in summary if result.get("skipped"))
+        if skipped:
+            print ("Unchanged files skipped:", skipped)
+
+def find_input_files(input_path):
+    if os.path.isfile(input_path):
+        return [input_path]
+    inputfiles = []
+    if os.path.isdir(input_path):
+        inputfiles = glob.glob(input_path + os.path.sep + '*.ts')
+        inputfiles.extend(glob.glob(input_path + os.path.sep + '*.mp4'))
+    return inputfiles
+
+def get_watch_state_file():
+    return os.path.join(folder, "watch_state.json")
+
+def read_watch_state():
+    try:
+        with open(get_watch_state_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_watch_state(state):
+    #Written to a temporary file first, a crash never leaves half a state behind
+    state_file = get_watch_state_file()
+    with open(state_file + ".part", "w") as f:
+        json.dump(state, f, indent = 1)
+    os.replace(state_file + ".part", state_file)
+
+def setup_watch_worker(run_args):
+    #Ctrl+C reaches the whole process group, the main process alone decides what happens to running files
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup(run_args)
+
+def start_watch_pool():
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs), initializer=setup_watch_worker, initargs=(args,))
+
+def finish_watch_job(entry, future):
+    """Records the result of a finished file in its watch state entry. A failed file stays queued until it has been started --watch_attempts times
+    return: result of the file, None if it is queued again
+    """
+    try:
+        result = future.result()
+        entry.update(state = "done", images = result["images"])
+        return result
+    except concurrent.futures.process.BrokenProcessPool:
+        error = "worker process died"
+    except Exception as e:
+        error = str(e)
+    print (entry["file"], " failed: ", error)
+    if entry.get("attempts", 0) < args.watch_attempts:
+        return None
+    entry.update(state = "failed", error = error)
+    return {"file": entry["file"], "images": 0, "error": error}
+
+def watch(input_path):
+    """Processes files as they arrive until interrupted. A file is queued once its size and modification time have
+    not changed for --watch_settle seconds, at most --jobs files are processed at a time. Queued files are kept in
+    the state file, so a restarted watch picks them up again, interrupted ones resume through the manifest.
+    A worker that dies, killed or out of memory, is replaced by a new pool.
+    return: results of the files processed
+    """
+    state = read_watch_state()
+    seen = {} #file: (size, mtime, time first seen with them)
+    running = {} #future: file
+    summary = []
+    print ("Watching", input_path, "every", args.watch_interval, "s, Ctrl+C to stop")
+    executor = start_watch_pool()
+    broken = False
+    try:
+        while True:
+            now = time.time()
+            changed = False
+            for input_file in find_input_files(input_path):
+                try:
+                    stat = os.stat(input_file)
+                except OSError:
+                    continue #removed meanwhile
+                key = os.path.abspath(input_file)
+                entry = state.get(key)
+                if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                    continue #queued, running or finished already
+                size = (stat.st_size, stat.st_mtime_ns)
+                if seen.get(key, (None, None))[:2] != size:
+                    seen[key] = size + (now,)
+                elif now - seen[key][2] >= args.watch_settle:
+                    state[key] = {"file": input_file, "size": stat.st_size, "mtime": stat.st_mtime_ns, "state": "queued"}
+                    del seen[key]
+                    changed = True
+                    print (input_file, " queued")
+
+            for future in [future for future in running if future.done()]:
+                broken = broken or isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool)
+                result = finish_watch_job(state[running.pop(future)], future)
+                if result:
+                    summary.append(result)
+                changed = True
+            if broken and not running:
+                print ("A worker process died, starting new ones")
+                executor.shutdown(wait = False)
+                executor = start_watch_pool()
+                broken = False
+
+            busy = set(running.values())
+            for key, entry in state.items():
+                if len(running) >= max(1, args.jobs) or broken:
+                    break
+                if entry["state"] == "queued" and key not in busy:
                     try:
-                        framecount = int(i*fps + fps * float(meters-locdata[i]["metric"])/float(locdata[i]["prevdist"]))
-                    except:
-                        framecount = int(i*fps)
-                else:
-                    framecount = length + 1
-                
-            else:
-                framecount += int(fps*args.sampling_interval)
-            #print('Frame: ', framecount)
-            if args.suppress_cv2_warnings == 1:
-                with suppress_stdout_stderr(): #Just to keep the console clear from OpenCV warning messages
-                    video.set(1,framecount)
-                    success,image = video.read()
-            else:
-                video.set(1,framecount)
-                success,image = video.read()
-        video.release()
-        try:
-            os.unlink("tmp.jpg")
-            print (input_ts_file, " processed, ", count, " images extracted")
-        except:
-            pass
-        
+                        future = executor.submit(run_profiled, process_file, entry["file"])
+                    except concurrent.futures.process.BrokenProcessPool:
+                        broken = True #the running files fail too, the pool is replaced once they are collected
+                        break
+                    entry["attempts"] = entry.get("attempts", 0) + 1
+                    running[future] = key
+                    changed = True
+
+            if changed:
+                write_watch_state(state)
+            time.sleep(args.watch_interval)
+    except KeyboardInterrupt:
+        print ("Watch stopped, waiting for", len(running), "running files, queued ones are processed on the next start")
+        executor.shutdown(wait = True, cancel_futures = True)
+        for future, key in running.items():
+            result = finish_watch_job(state[key], future)
+            if result:
+                summary.append(result)
+        write_watch_state(state)
+    return summary
+
+def main():
+    run_args = parser.parse_args()
+    if not run_args.input and not run_args.plan:
+        parser.error("--input or --plan is required")
+    if OUTPUT_PROFILES[run_args.output_profile]["params"] is None:
+        parser.error("--output_profile " + run_args.output_profile + " needs a newer OpenCV than " + cv2.__version__)
+    setup(run_args)
+    print(args)
+    try:
+        os.mkdir(folder)
+    except:
+        pass
+
+    if args.plan:
+        plans = read_plans(args.plan)
+        summary = run_jobs(execute_plan, plans, [plan["file"] for plan in plans])
+    else:
+        if args.watch == 1:
+            summary = watch(args.input)
+        elif args.trip == 1:
+            summary = run_trips(find_input_files(args.input))
+        else:
+            inputfiles = find_input_files(args.input)
+            summary = run_jobs(process_file, inputfiles, inputfiles)
+    print_summary(summary)
+    if args.profile == 1:
+        write_profile(summary)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 #For this: https://forum.mapillary.com/t/blueskysea-b4k-viofo-a119v3-and-mapillary
 #Usage: python tss_gps_data.py 20210109161626_000009A.tts
 
-import struct
+import os
 import sys
+import numpy as np
 try:
     input_ts_file = sys.argv[1]
 except:
@@ -17,55 +18,53 @@ except:
     else:
         device = 'V'
 
-def fix_coordinates(hemisphere,coordinate_input): #From here: https://sergei.nz/extracting-gps-data-from-viofo-a119-and-other-novatek-powered-cameras/
-    coordinate, = coordinate_input
+#Field layout of the GPS packets inside 188-byte TS packets, same as in ts_processor.py
+VIOFO_PACKET = np.dtype({
+    'names': ['hour','minute','second','year','month','day','active','lathem','lonhem','lat','lon','speed','bearing'],
+    'formats': ['<u4','<u4','<u4','<u4','<u4','<u4','S1','S1','S1','<f4','<f4','<f4','<f4'],
+    'offsets': [10,14,18,22,26,30,34,35,36,38,42,46,50],
+    'itemsize': 188})
+B4K_PACKET = np.dtype({
+    'names': ['year_high','month','day','active','lathem','lonhem','lat','lon','speed','bearing'],
+    'formats': ['<u2','<u4','<u4','S1','S1','S1','<f4','<f4','<f4','<f4'],
+    'offsets': [146,148,152,156,157,158,160,164,168,172],
+    'itemsize': 188})
+B4K_PREVIOUS_PACKET = np.dtype({
+    'names': ['hour','minute','second','year_low'],
+    'formats': ['<u4','<u4','<u4','<u2'],
+    'offsets': [174,178,182,186],
+    'itemsize': 188})
+
+def fix_coordinates(hemisphere,coordinate): #From here: https://sergei.nz/extracting-gps-data-from-viofo-a119-and-other-novatek-powered-cameras/
+    coordinate = coordinate.astype(np.float64)
     minutes = coordinate % 100.0
     degrees = coordinate - minutes
     coordinate = degrees / 100.0 + (minutes / 60.0)
-    if hemisphere == 'S' or hemisphere == 'W':
-        return -1*float(coordinate)
+    return np.where((hemisphere == b'S') | (hemisphere == b'W'), -coordinate, coordinate)
+
+print ("timestamp","GPS active","NW hemisphere","EW hemisphere","lat","lon","speed","bearing",sep=';')
+packet_count = os.path.getsize(input_ts_file) // 188
+if packet_count > 1:
+    #Look at the whole file at once instead of 188 bytes at a time
+    packets = np.memmap(input_ts_file, dtype=np.uint8, mode='r', shape=(packet_count, 188))
+    if device == 'B':
+        selected = (packets[:, 0] == 0x47) & (packets[:, 1] == 0x03) & (packets[:, 2] == 0x00)
+        selected[0] = False #needs the previous packet
+        index = np.flatnonzero(selected)
+        current = np.ascontiguousarray(packets[index]).view(B4K_PACKET)[:, 0]
+        previous = np.ascontiguousarray(packets[index - 1]).view(B4K_PREVIOUS_PACKET)[:, 0]
+        hour, minute, second = previous['hour'], previous['minute'], previous['second']
+        year = previous['year_low'].astype(np.uint32) | (current['year_high'].astype(np.uint32) << 16)
     else:
-        return float(coordinate)
-    
-prevpacket = None
-with open(input_ts_file, "rb") as f:
-    print ("timestamp","GPS active","NW hemisphere","EW hemisphere","lat","lon","speed","bearing",sep=';')
-    while True:
-        input_packet = f.read(188)
-        if not input_packet:
-            break
-        if device == 'B' and prevpacket and input_packet.startswith(bytes("\x47\x03\x00", encoding="raw_unicode_escape")):
-            bs = list(input_packet)
-            hour = int.from_bytes(prevpacket[174:178], byteorder='little')
-            minute = int.from_bytes(prevpacket[178:182], byteorder='little')
-            second = int.from_bytes(prevpacket[182:186], byteorder='little')
-            year = int.from_bytes(prevpacket[186:188] + input_packet[146:148], byteorder='little')
-            month = int.from_bytes(input_packet[148:152], byteorder='little')
-            day = int.from_bytes(input_packet[152:156], byteorder='little')
-            active = chr(bs[156])
-            lathem = chr(bs[157])
-            lonhem = chr(bs[158])
-            lat = fix_coordinates(lathem,struct.unpack('<f', input_packet[160:164]))
-            lon = fix_coordinates(lonhem,struct.unpack('<f', input_packet[164:168]))
-            speed_knots, = struct.unpack('<f', input_packet[168:172])
-            speed = speed_knots * 1.6 / 3.6
-            bearing, = struct.unpack('<f', input_packet[172:176])
-            print ('20{0:02}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(year,month,day,hour,minute,second),active,lathem,lonhem,lat,lon,speed,bearing, sep=';')
-        if device == 'V' and input_packet.startswith(bytes("\x47\x43\x00", encoding="raw_unicode_escape")):
-            bs = list(input_packet)
-            hour = int.from_bytes(input_packet[10:14], byteorder='little')
-            minute = int.from_bytes(input_packet[14:18], byteorder='little')
-            second = int.from_bytes(input_packet[18:22], byteorder='little')
-            year = int.from_bytes(input_packet[22:26], byteorder='little')
-            month = int.from_bytes(input_packet[26:30], byteorder='little')
-            day = int.from_bytes(input_packet[30:34], byteorder='little')
-            active = chr(bs[34])
-            lathem = chr(bs[35])
-            lonhem = chr(bs[36])
-            lat = fix_coordinates(lathem,struct.unpack('<f', input_packet[38:42]))
-            lon = fix_coordinates(lonhem,struct.unpack('<f', input_packet[42:46]))
-            speed_knots, = struct.unpack('<f', input_packet[46:50])
-            speed = speed_knots * 1.6 / 3.6
-            bearing, = struct.unpack('<f', input_packet[50:54])
-            print ('20{0:02}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(year,month,day,hour,minute,second),active,lathem,lonhem,lat,lon,speed,bearing, sep=';')
-        prevpacket = input_packet
\ No newline at end of file
+        selected = (packets[:, 0] == 0x47) & (packets[:, 1] == 0x43) & (packets[:, 2] == 0x00)
+        index = np.flatnonzero(selected)
+        current = np.ascontiguousarray(packets[index]).view(VIOFO_PACKET)[:, 0]
+        hour, minute, second, year = current['hour'], current['minute'], current['second'], current['year']
+    lat = fix_coordinates(current['lathem'], current['lat'])
+    lon = fix_coordinates(current['lonhem'], current['lon'])
+    speed = current['speed'].astype(np.float64) * 1.6 / 3.6
+    bearing = current['bearing'].astype(np.float64)
+    rows = zip(year.tolist(), current['month'].tolist(), current['day'].tolist(), hour.tolist(), minute.tolist(), second.tolist(),
+        current['active'].tolist(), current['lathem'].tolist(), current['lonhem'].tolist(), lat.tolist(), lon.tolist(), speed.tolist(), bearing.tolist())
+    for year,month,day,hour,minute,second,active,lathem,lonhem,lat,lon,speed,bearing in rows:
+        print ('20{0:02}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(year,month,day,hour,minute,second),active.decode("latin-1"),lathem.decode("latin-1"),lonhem.decode("latin-1"),lat,lon,speed,bearing, sep=';')